@@ -1,10 +1,30 @@
-from fastapi import FastAPI, HTTPException, Body, Request
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Body, Request, Response, WebSocket
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from contextlib import contextmanager, nullcontext
+from pydantic import BaseModel, ValidationError, conlist
+from typing import Optional, List
 from redis import Redis
-from rq import Queue
+from redis.asyncio import Redis as AsyncRedis, BlockingConnectionPool, ConnectionPool
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError, WatchError
+from rq import Queue, Retry
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
 import json
+import math
+import uuid
+import asyncio
+import os
+import time
 from fastapi.middleware.cors import CORSMiddleware
 
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer("aerovrtuoso.api")
+except ImportError:
+    tracer = None
+
 app = FastAPI()
 
 app.add_middleware(
@@ -15,9 +35,61 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# create redis queue
-redis_conn = Redis(host='redis', port=6379)
-task_queue = Queue("task_queue", connection=redis_conn, db=0)
+# metrics, exposed at /metrics
+request_seconds = Histogram("api_request_seconds", "Request handling time per route", ["method", "route"])
+redis_seconds = Histogram("api_redis_seconds", "Redis command time per operation", ["operation"], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+queued_instructions = Counter("api_instructions_total", "Instructions queued per action", ["action"])
+folded_instructions = Counter("api_instructions_folded_total", "Instructions merged into or cancelled by a queued one", ["kind"])
+# sessions are named by the clients, the queue length is observed without a session label
+queue_length = Histogram("api_queue_length", "Instructions waiting for Unity, observed at every push and pop", buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 1000))
+
+@contextmanager
+def redis_span(operation):
+    span = tracer.start_as_current_span(f"redis.{operation}") if tracer is not None else nullcontext()
+    with span, redis_seconds.labels(operation).time():
+        yield
+
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+    start_time = time.perf_counter()
+    span = tracer.start_as_current_span("http.request", attributes={"http.method": request.method, "http.path": request.url.path}) if tracer is not None else nullcontext()
+    with span:
+        response = await call_next(request)
+
+    # label with the route template so ids in the path do not create new series
+    route = request.scope.get("route")
+    request_seconds.labels(request.method, getattr(route, "path", "unmatched")).observe(time.perf_counter() - start_time)
+    return response
+
+# redis settings
+# REDIS_POOL_SIZE - connections shared by all requests of a worker, the long-polls hold one while they wait
+# REDIS_POOL_TIMEOUT - how long a request waits for a free connection before failing (seconds)
+# PUBSUB_POOL_SIZE - connections for the /events/response subscribers, each one holds its own for as long as it is connected,
+#   they have their own pool so the subscribers can never starve the request handlers
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "64"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+PUBSUB_POOL_SIZE = int(os.getenv("PUBSUB_POOL_SIZE", "256"))
+
+# async client for the request handlers, the event loop never waits on a socket
+redis_pool = BlockingConnectionPool(host=REDIS_HOST, port=6379, max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT)
+redis_conn = AsyncRedis(connection_pool=redis_pool)
+
+# subscriptions fail right away once the pool is used up instead of waiting for a subscriber to leave
+pubsub_pool = ConnectionPool(host=REDIS_HOST, port=6379, max_connections=PUBSUB_POOL_SIZE)
+pubsub_conn = AsyncRedis(connection_pool=pubsub_pool)
+
+# create redis queue, rq only works with the synchronous client
+rq_conn = Redis(host=REDIS_HOST, port=6379)
+task_queue = Queue("task_queue", connection=rq_conn)
+
+# prompt jobs, run by the llm workers (server/llm/worker.py)
+# PROMPT_JOB_TIMEOUT - how long one prompt may run on a worker (seconds)
+# PROMPT_JOB_RETRIES - retries of a job whose worker failed or died
+# PROMPT_RESULT_TTL - how long a finished job and its result are kept (seconds)
+PROMPT_JOB_TIMEOUT = int(os.getenv("PROMPT_JOB_TIMEOUT", "120"))
+PROMPT_JOB_RETRIES = int(os.getenv("PROMPT_JOB_RETRIES", "2"))
+PROMPT_RESULT_TTL = int(os.getenv("PROMPT_RESULT_TTL", "3600"))
 
 class SpawnObject(BaseModel):
     reference_object: str
@@ -53,68 +125,153 @@ class RotateObject(BaseModel):
 
 class UserPrompt(BaseModel):
     prompt: str
+    session_id: str = "default"
+
+class InstructionObject(BaseModel):
+    action: str
+    parameters: dict
+
+class InstructionBatch(BaseModel):
+    instructions: List[InstructionObject]
 
 class StatusRequest(BaseModel):
     status: bool
+    startup: Optional[dict] = None
 
 class UnityResponseObject(BaseModel):
     message: str
     current_objects: str
     available_prefabs: str
+    instruction_id: Optional[str] = None
 
-currentInstruction = {
-    "action": "",
-    "parameters": ""
-}
+# structured scene graph, Unity sends the full scene once and incremental deltas afterwards
+Vector3 = conlist(float, min_length=3, max_length=3)
+
+class SceneObject(BaseModel):
+    id: str
+    name: str
+    prefab: str
+    position: Vector3 = [0.0, 0.0, 0.0]
+    rotation: Vector3 = [0.0, 0.0, 0.0]
+    scale: Vector3 = [1.0, 1.0, 1.0]
+
+class SceneTransform(BaseModel):
+    id: str
+    position: Optional[Vector3] = None
+    rotation: Optional[Vector3] = None
+    scale: Optional[Vector3] = None
+
+class SceneSnapshot(BaseModel):
+    objects: List[SceneObject] = []
+    available_prefabs: List[str] = []
+
+class SceneDelta(BaseModel):
+    # rejected with 409 when the scene moved past base_version, Unity then sends a snapshot
+    base_version: Optional[int] = None
+    added: List[SceneObject] = []
+    moved: List[SceneTransform] = []
+    removed: List[str] = []
+    available_prefabs: Optional[List[str]] = None
 
-responseFromUnity = {"response": ""}
 prompt = {
     "instruction": ""
 }
 
-llmStatus = False
+instruction_models = {
+    "spawn": SpawnObject,
+    "snap": SnapObject,
+    "move": MoveObject,
+    "remove": RemoveObject,
+    "replace": ReplaceObject,
+    "scale": ScaleObject,
+    "rotate": RotateObject
+}
 
 axisList = ['x', 'y', 'z', 'reset', 'default']
 scaleList = ['x_up', 'y_up', 'z_up', 'x_down', 'y_down', 'z_down', 'multiply', 'increase', 'decrease', 'reset', 'default']
 directionsList = ["left", "right", "front", "back", "top", "bottom", "default"]
 
-@app.post("/set/spawn")
-async def set_spawn(spawn_obj: SpawnObject):
-    spawn_params = dict(spawn_obj)
-    print(type(spawn_obj))
-    if spawn_params['direction'].lower() not in directionsList:
+# every Unity scene gets its own instruction queue and scene state in Redis,
+# the default session keeps the original key names
+DEFAULT_SESSION = "default"
+
+def session_key(name, session_id):
+    if session_id == DEFAULT_SESSION:
+        return name
+    return f"session:{session_id}:{name}"
+
+# how long a Unity acknowledgement is kept for the waiting caller (seconds)
+ACK_TTL = 60
+
+# limits for the long-poll on GET /instruction
+MAX_POLL_TIMEOUT = 30
+MAX_POLL_ITEMS = 100
+
+# how long the push channels block on Redis before checking the client again (seconds)
+STREAM_POLL_TIMEOUT = 1
+
+# retries of a scene update that raced with another one
+SCENE_WRITE_RETRIES = 3
+MAX_SCENE_QUERY_ITEMS = 100
+
+# instruction coalescing, a new instruction is folded into the last queued one before Unity pops it
+# COALESCE_INSTRUCTIONS - sum moves per direction and rotations per axis of the same prefab, a spawn followed by its remove cancels out
+COALESCE_INSTRUCTIONS = os.getenv("COALESCE_INSTRUCTIONS", "false").lower() == "true"
+COALESCE_WRITE_RETRIES = 3
+
+# how long the ids folded into a queued instruction wait for its acknowledgement (seconds)
+MERGED_TTL = 3600
+
+# instruction transport
+# INSTRUCTION_TRANSPORT - "list" pops the instructions off a Redis list, "stream" reads them from a Redis Stream
+#   through consumer groups: every group sees every instruction, the consumers of one group share them and
+#   a delivered instruction stays pending until it is acknowledged, coalescing only applies to the list
+# STREAM_MAXLEN - about how many instructions the stream keeps for replay
+# STREAM_GROUP - group of the Unity clients, observers read with a group of their own
+# STREAM_GROUP_START - where a new group starts reading, "0" for everything still in the stream, "$" for new instructions only
+# STREAM_CLAIM_IDLE - instructions left pending this long by a consumer are handed to the next one that reads (seconds, 0 disables)
+INSTRUCTION_TRANSPORT = os.getenv("INSTRUCTION_TRANSPORT", "list").lower()
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", "10000"))
+STREAM_GROUP = os.getenv("STREAM_GROUP", "unity")
+STREAM_GROUP_START = os.getenv("STREAM_GROUP_START", "0")
+STREAM_CLAIM_IDLE = float(os.getenv("STREAM_CLAIM_IDLE", "30"))
+DEFAULT_CONSUMER = "default"
+
+opposite_directions = {"left": "right", "right": "left", "front": "back", "back": "front", "top": "bottom", "bottom": "top"}
+
+def check_parameters(action, parameters):
+    # raises the same errors as the single /set/<action> endpoints
+    if action in ("spawn", "move") and parameters['direction'].lower() not in directionsList:
         raise HTTPException(status_code=400, detail=f"Direction is invalid. {directionsList}")
-    elif not spawn_params['value'].isdigit():
+    if action == "scale" and parameters['axis'].lower() not in scaleList:
+        raise HTTPException(status_code=400, detail=f"Axis is invalid. {scaleList}")
+    if action == "rotate" and parameters['axis'].lower() not in axisList:
+        raise HTTPException(status_code=400, detail=f"Axis is invalid. {axisList}")
+    if 'value' in parameters and not parameters['value'].isdigit():
         raise HTTPException(status_code=400, detail="Value should be a number.")
-    else:
-        currentInstruction['action'] = "spawn"
-        currentInstruction['parameters'] = spawn_params
-    
-        try:
-            redis_conn.rpush('instruction', json.dumps(currentInstruction))
-            return {
-                "success": True,
-                "message": "Pushed to Redis Queue",
-                "payload": currentInstruction
-            }
-        except Exception as e:
-            return {
-                "success": False,
-                "error": str(e)
-            }
 
-@app.post("/set/snap")
-async def set_snap(snap_obj: SnapObject):
-    snap_params = dict(snap_obj)
-    currentInstruction['action'] = "snap"
-    currentInstruction['parameters'] = snap_params
+async def push_instruction(action, parameters, session_id=DEFAULT_SESSION):
+    # every instruction gets an id so the Unity response can be matched to it
+    instruction = {
+        "id": str(uuid.uuid4()),
+        "action": action,
+        "parameters": parameters
+    }
+
+    if INSTRUCTION_TRANSPORT == "stream":
+        return await push_stream([instruction], session_id, batch=False)
+    if COALESCE_INSTRUCTIONS:
+        return await push_coalesced([instruction], session_id, batch=False)
 
     try:
-        redis_conn.rpush('instruction', json.dumps(currentInstruction))
+        with redis_span("push"):
+            length = await redis_conn.rpush(session_key('instruction', session_id), json.dumps(instruction))
+        queue_length.observe(length)
+        queued_instructions.labels(action).inc()
         return {
             "success": True,
             "message": "Pushed to Redis Queue",
-            "payload": currentInstruction
+            "payload": instruction
         }
     except Exception as e:
         return {
@@ -122,43 +279,34 @@ async def set_snap(snap_obj: SnapObject):
             "error": str(e)
         }
 
-@app.post("/set/move")
-async def set_move(move_obj: MoveObject):
-    move_params = dict(move_obj)
-    if move_params['direction'].lower() not in directionsList:
-        raise HTTPException(status_code=400, detail=f"Direction is invalid. {directionsList}")
-    elif not move_params['value'].isdigit():
-        raise HTTPException(status_code=400, detail="Value should be a number.")
-    else:
-        currentInstruction['action'] = "move"
-        currentInstruction['parameters'] = move_params
-        
-        try:
-            redis_conn.rpush('instruction', json.dumps(currentInstruction))
-            return {
-                "success": True,
-                "message": "Pushed to Redis Queue",
-                "payload": currentInstruction
-            }
-        except Exception as e:
-            return {
-                "success": False,
-                "error": str(e)
-            }
+async def push_instructions(instructions, session_id=DEFAULT_SESSION):
+    # queue several instructions in one MULTI transaction, Unity never sees a partial batch
+    instructions = [
+        {
+            "id": str(uuid.uuid4()),
+            "action": action,
+            "parameters": parameters
+        }
+        for action, parameters in instructions
+    ]
 
-@app.post("/set/remove")
-async def set_remove(remove_obj: RemoveObject):
-    remove_params = dict(remove_obj)
+    if INSTRUCTION_TRANSPORT == "stream":
+        return await push_stream(instructions, session_id)
+    if COALESCE_INSTRUCTIONS:
+        return await push_coalesced(instructions, session_id)
 
-    currentInstruction['action'] = "remove"
-    currentInstruction['parameters'] = remove_params
-    
     try:
-        redis_conn.rpush('instruction', json.dumps(currentInstruction))
+        with redis_span("push_batch"):
+            async with redis_conn.pipeline(transaction=True) as pipe:
+                pipe.rpush(session_key('instruction', session_id), *[json.dumps(instruction) for instruction in instructions])
+                length, = await pipe.execute()
+        queue_length.observe(length)
+        for instruction in instructions:
+            queued_instructions.labels(instruction['action']).inc()
         return {
             "success": True,
-            "message": "Pushed to Redis Queue",
-            "payload": currentInstruction
+            "message": f"Pushed {len(instructions)} instructions to Redis Queue",
+            "payload": instructions
         }
     except Exception as e:
         return {
@@ -166,99 +314,960 @@ async def set_remove(remove_obj: RemoveObject):
             "error": str(e)
         }
 
-@app.post("/set/replace")
-async def set_replace(replace_obj: ReplaceObject):
-    replace_params = dict(replace_obj)
-    currentInstruction['action'] = "replace"
-    currentInstruction['parameters'] = replace_params
-    
+def coalesce(previous, instruction):
+    # ("merge", instruction replacing both), ("cancel", None) when they undo each other, (None, None) otherwise
+    before, after = previous['parameters'], instruction['parameters']
+    if before.get('prefab', '').lower() != after.get('prefab', '').lower():
+        return None, None
+
+    if previous['action'] == "spawn" and instruction['action'] == "remove":
+        return "cancel", None
+
+    if previous['action'] != instruction['action'] or not before.get('value', '').isdigit() or not after.get('value', '').isdigit():
+        return None, None
+
+    if instruction['action'] == "move":
+        direction = before['direction'].lower()
+        if after['direction'].lower() == direction:
+            value = int(before['value']) + int(after['value'])
+        elif after['direction'].lower() == opposite_directions.get(direction):
+            value = int(before['value']) - int(after['value'])
+        else:
+            return None, None
+
+        if value == 0:
+            return "cancel", None
+        # a larger opposite move flips the direction
+        if value < 0:
+            direction, value = after['direction'], -value
+        else:
+            direction = before['direction']
+        return "merge", {**previous, "parameters": {**before, "direction": direction, "value": str(value)}}
+
+    if instruction['action'] == "rotate" and before['axis'].lower() == after['axis'].lower() and before['axis'].lower() in ('x', 'y', 'z'):
+        return "merge", {**previous, "parameters": {**before, "value": str(int(before['value']) + int(after['value']))}}
+
+    return None, None
+
+def fold_instructions(tail, instructions):
+    # end of the queue after folding the new instructions into the last queued one and into each other,
+    # with the ids merged into another instruction and the ids that cancelled out
+    queued = [tail] if tail is not None else []
+    merged = {}
+    cancelled = []
+
+    for instruction in instructions:
+        kind, result = coalesce(queued[-1], instruction) if queued else (None, None)
+        if kind == "merge":
+            merged[instruction['id']] = result['id']
+            queued[-1] = result
+        elif kind == "cancel":
+            previous = queued.pop()
+            folded = [folded_id for folded_id, target_id in merged.items() if target_id == previous['id']]
+            for folded_id in folded:
+                del merged[folded_id]
+            cancelled += [previous['id'], instruction['id'], *folded]
+        else:
+            queued.append(instruction)
+
+    return queued, merged, cancelled
+
+async def push_coalesced(instructions, session_id=DEFAULT_SESSION, batch=True):
+    # the last queued instruction is rewritten under WATCH, Unity popping it in between retries the fold
+    instruction_key = session_key('instruction', session_id)
+    stats_key = session_key('coalesce_stats', session_id)
+
     try:
-        redis_conn.rpush('instruction', json.dumps(currentInstruction))
+        for attempt in range(COALESCE_WRITE_RETRIES):
+            try:
+                with redis_span("push_coalesced"):
+                    async with redis_conn.pipeline(transaction=True) as pipe:
+                        await pipe.watch(instruction_key)
+                        raw_tail = await pipe.lindex(instruction_key, -1)
+                        tail = json.loads(raw_tail) if raw_tail else None
+                        queued, merged, cancelled = fold_instructions(tail, instructions)
+
+                        tail_kept = tail is not None and bool(queued) and queued[0]['id'] == tail['id']
+                        new_instructions = queued[1:] if tail_kept else queued
+
+                        # a cancelled tail takes the ids folded into it earlier along, they were already counted as merged
+                        scene_state = None
+                        earlier_folded = []
+                        if tail is not None and not tail_kept:
+                            earlier_folded = [folded_id.decode() for folded_id in await pipe.lrange(f"merged:{tail['id']}", 0, -1)]
+                        if cancelled:
+                            scene_state = await pipe.get(session_key('response', session_id))
+
+                        pipe.multi()
+                        if tail is not None and not tail_kept:
+                            pipe.rpop(instruction_key)
+                            pipe.delete(f"merged:{tail['id']}")
+                        elif tail_kept and queued[0] != tail:
+                            pipe.lset(instruction_key, -1, json.dumps(queued[0]))
+                        if new_instructions:
+                            pipe.rpush(instruction_key, *[json.dumps(instruction) for instruction in new_instructions])
+
+                        # folded ids are acknowledged together with the instruction they were merged into
+                        for folded_id, target_id in merged.items():
+                            pipe.rpush(f"merged:{target_id}", folded_id)
+                            pipe.expire(f"merged:{target_id}", MERGED_TTL)
+
+                        # cancelled ids are never delivered, their callers get the current scene right away
+                        scene = json.loads(scene_state) if scene_state else {"current_objects": "", "available_prefabs": ""}
+                        for cancelled_id in cancelled + earlier_folded:
+                            ack_key = f"ack:{cancelled_id}"
+                            pipe.rpush(ack_key, json.dumps({**scene, "message": "Cancelled by a later instruction before delivery.", "instruction_id": cancelled_id}))
+                            pipe.expire(ack_key, ACK_TTL)
+
+                        pipe.hincrby(stats_key, "pushed", len(instructions))
+                        pipe.hincrby(stats_key, "merged", len(merged))
+                        pipe.hincrby(stats_key, "cancelled", len(cancelled))
+                        pipe.llen(instruction_key)
+                        results = await pipe.execute()
+                break
+            except WatchError:
+                if attempt == COALESCE_WRITE_RETRIES - 1:
+                    raise
+    except Exception as e:
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+    queue_length.observe(results[-1])
+    for instruction in instructions:
+        queued_instructions.labels(instruction['action']).inc()
+    folded_instructions.labels("merged").inc(len(merged))
+    folded_instructions.labels("cancelled").inc(len(cancelled))
+
+    folded = {
+        "merged": merged,
+        "cancelled": cancelled + earlier_folded
+    }
+    if not batch:
+        instruction = instructions[0]
+        if instruction['id'] in merged:
+            message = f"Merged into queued instruction {merged[instruction['id']]}"
+        elif instruction['id'] in cancelled:
+            message = "Cancelled a queued instruction"
+        else:
+            message = "Pushed to Redis Queue"
         return {
             "success": True,
-            "message": "Pushed to Redis Queue",
-            "payload": currentInstruction
+            "message": message,
+            "payload": instruction,
+            "folded": folded
         }
+
+    return {
+        "success": True,
+        "message": f"Pushed {len(instructions)} instructions to Redis Queue, {len(merged)} merged and {len(cancelled)} cancelled",
+        "payload": instructions,
+        "folded": folded
+    }
+
+async def get_coalesce_stats(session_id=DEFAULT_SESSION):
+    stats = await redis_conn.hgetall(session_key('coalesce_stats', session_id))
+    stats = {field.decode(): int(value) for field, value in stats.items()}
+    pushed = stats.get("pushed", 0)
+    folded = stats.get("merged", 0) + stats.get("cancelled", 0)
+    return {
+        "enabled": COALESCE_INSTRUCTIONS,
+        "pushed": pushed,
+        "merged": stats.get("merged", 0),
+        "cancelled": stats.get("cancelled", 0),
+        "folded_ratio": folded / pushed if pushed else 0.0
+    }
+
+async def pop_instructions(timeout=0, max_items=1, session_id=DEFAULT_SESSION):
+    instruction_key = session_key('instruction', session_id)
+
+    # block for the first instruction when a timeout is given, then take whatever else is queued
+    raw_instructions = []
+    if timeout > 0:
+        result = await redis_conn.blpop(instruction_key, timeout)
+        if result is None:
+            return []
+        raw_instructions.append(result[1])
+        max_items -= 1
+
+    # the rest of the batch and the remaining queue length in one round trip
+    with redis_span("pop"):
+        async with redis_conn.pipeline(transaction=False) as pipe:
+            if max_items > 0:
+                pipe.lpop(instruction_key, max_items)
+            pipe.llen(instruction_key)
+            results = await pipe.execute()
+    if max_items > 0:
+        raw_instructions += results[0] or []
+    queue_length.observe(results[-1])
+
+    instructions = [json.loads(raw_instruction) for raw_instruction in raw_instructions]
+
+    # delivered instructions wait for their Unity response
+    instruction_ids = [instruction['id'] for instruction in instructions if instruction.get('id')]
+    if instruction_ids:
+        await redis_conn.rpush(session_key('awaiting_ack', session_id), *instruction_ids)
+
+    return instructions
+
+async def requeue_instructions(instructions, session_id=DEFAULT_SESSION):
+    # put undelivered instructions back at the front of the queue, in their original order
+    if not instructions:
+        return
+
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.lpush(session_key('instruction', session_id), *[json.dumps(instruction) for instruction in reversed(instructions)])
+        for instruction in instructions:
+            if instruction.get('id'):
+                pipe.lrem(session_key('awaiting_ack', session_id), 1, instruction['id'])
+        await pipe.execute()
+
+# groups known to exist, checked once per process
+stream_groups = set()
+
+def stream_keys(session_id):
+    # stream: the instructions, entries: instruction id -> stream entry id, to acknowledge a Unity response,
+    # instructions: stream entry id -> instruction id, to drop the mapping of an entry acknowledged or trimmed by its id
+    return {
+        "stream": session_key('instruction_stream', session_id),
+        "entries": session_key('instruction_entries', session_id),
+        "instructions": session_key('instruction_entry_ids', session_id)
+    }
+
+async def forget_stream_entries(entry_ids, session_id=DEFAULT_SESSION):
+    # the entries left the Unity group, their instructions cannot be acknowledged through them anymore
+    if not entry_ids:
+        return
+    keys = stream_keys(session_id)
+    instruction_ids = [instruction_id for instruction_id in await redis_conn.hmget(keys['instructions'], entry_ids) if instruction_id]
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.hdel(keys['instructions'], *entry_ids)
+        if instruction_ids:
+            pipe.hdel(keys['entries'], *instruction_ids)
+            for instruction_id in instruction_ids:
+                pipe.lrem(session_key('awaiting_ack', session_id), 0, instruction_id)
+        await pipe.execute()
+
+async def ensure_stream_group(stream_key, group):
+    if (stream_key, group) in stream_groups:
+        return
+    try:
+        await redis_conn.xgroup_create(stream_key, group, id=STREAM_GROUP_START, mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+    stream_groups.add((stream_key, group))
+
+def stream_instructions(entries):
+    # entries trimmed from the stream while pending come back without fields
+    return [
+        {**json.loads(fields[b'instruction']), "stream_id": entry_id.decode()}
+        for entry_id, fields in entries
+        if fields
+    ]
+
+async def push_stream(instructions, session_id=DEFAULT_SESSION, batch=True):
+    keys = stream_keys(session_id)
+
+    try:
+        # the Unity group exists before the first instruction so it cannot miss it
+        await ensure_stream_group(keys['stream'], STREAM_GROUP)
+
+        with redis_span("xadd"):
+            async with redis_conn.pipeline(transaction=True) as pipe:
+                for instruction in instructions:
+                    pipe.xadd(keys['stream'], {"instruction": json.dumps(instruction)}, maxlen=STREAM_MAXLEN, approximate=True)
+                entry_ids = await pipe.execute()
+            async with redis_conn.pipeline(transaction=False) as pipe:
+                pipe.hset(keys['entries'], mapping={
+                    instruction['id']: entry_id for instruction, entry_id in zip(instructions, entry_ids)
+                })
+                pipe.hset(keys['instructions'], mapping={
+                    entry_id: instruction['id'] for instruction, entry_id in zip(instructions, entry_ids)
+                })
+                await pipe.execute()
     except Exception as e:
         return {
             "success": False,
             "error": str(e)
         }
 
+    for instruction, entry_id in zip(instructions, entry_ids):
+        instruction['stream_id'] = entry_id.decode()
+        queued_instructions.labels(instruction['action']).inc()
+
+    if not batch:
+        return {
+            "success": True,
+            "message": "Pushed to Redis Stream",
+            "payload": instructions[0]
+        }
+    return {
+        "success": True,
+        "message": f"Pushed {len(instructions)} instructions to Redis Stream",
+        "payload": instructions
+    }
+
+async def read_stream(timeout=0, max_items=1, session_id=DEFAULT_SESSION, group=STREAM_GROUP, consumer=DEFAULT_CONSUMER, recover=False):
+    stream_key = stream_keys(session_id)['stream']
+    await ensure_stream_group(stream_key, group)
+    entries = []
+    trimmed = []
+
+    with redis_span("xreadgroup"):
+        # a restarted consumer first gets what it was given before but never acknowledged,
+        # entries trimmed from the stream meanwhile come back without fields and are acknowledged
+        if recover:
+            result = await redis_conn.xreadgroup(group, consumer, {stream_key: "0"}, count=max_items)
+            recovered = result[0][1] if result else []
+            trimmed += [entry_id for entry_id, fields in recovered if not fields]
+            if trimmed:
+                await redis_conn.xack(stream_key, group, *trimmed)
+            entries += [(entry_id, fields) for entry_id, fields in recovered if fields]
+
+        # then the instructions a crashed consumer of the group left pending, XAUTOCLAIM drops the trimmed ones itself
+        if len(entries) < max_items and STREAM_CLAIM_IDLE > 0:
+            result = await redis_conn.xautoclaim(stream_key, group, consumer, int(STREAM_CLAIM_IDLE * 1000), start_id="0-0", count=max_items - len(entries))
+            entries += result[1]
+            trimmed += result[2] if len(result) > 2 else []
+        redelivered = len(entries)
+
+        # and the new ones, blocking only when there is nothing to hand out yet
+        if len(entries) < max_items:
+            block = int(timeout * 1000) if timeout > 0 and not entries else None
+            result = await redis_conn.xreadgroup(group, consumer, {stream_key: ">"}, count=max_items - len(entries), block=block)
+            entries += result[0][1] if result else []
+
+    instructions = stream_instructions(entries)
+    if group != STREAM_GROUP:
+        return instructions
+
+    await forget_stream_entries(trimmed, session_id)
+
+    # a response without an instruction id belongs to the oldest instruction given to the Unity group,
+    # a recovered or claimed instruction moves to the end instead of being waited on twice
+    instruction_ids = [instruction['id'] for instruction in instructions if instruction.get('id')]
+    if instruction_ids:
+        awaiting_key = session_key('awaiting_ack', session_id)
+        async with redis_conn.pipeline(transaction=True) as pipe:
+            for instruction in instructions[:redelivered]:
+                if instruction.get('id'):
+                    pipe.lrem(awaiting_key, 0, instruction['id'])
+            pipe.rpush(awaiting_key, *instruction_ids)
+            await pipe.execute()
+
+    return instructions
+
+async def ack_stream(stream_ids, session_id=DEFAULT_SESSION, group=STREAM_GROUP):
+    if not stream_ids:
+        return 0
+    with redis_span("xack"):
+        acknowledged = await redis_conn.xack(stream_keys(session_id)['stream'], group, *stream_ids)
+    if group == STREAM_GROUP:
+        await forget_stream_entries(stream_ids, session_id)
+    return acknowledged
+
+async def replay_stream(since=None, count=MAX_POLL_ITEMS, session_id=DEFAULT_SESSION):
+    # the instructions after the given stream id, read without a group so nothing is acknowledged or claimed
+    minimum = f"({since}" if since else "-"
+    entries = await redis_conn.xrange(stream_keys(session_id)['stream'], min=minimum, max="+", count=count)
+    return stream_instructions(entries)
+
+async def set_stream_group(group, start_id, session_id=DEFAULT_SESSION):
+    # create the group at start_id, or move an existing one there to replay from that offset
+    stream_key = stream_keys(session_id)['stream']
+    try:
+        await redis_conn.xgroup_create(stream_key, group, id=start_id, mkstream=True)
+        created = True
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+        await redis_conn.xgroup_setid(stream_key, group, start_id)
+        created = False
+    stream_groups.add((stream_key, group))
+    return {"group": group, "start_id": start_id, "created": created}
+
+async def get_stream_info(session_id=DEFAULT_SESSION):
+    stream_key = stream_keys(session_id)['stream']
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.exists(stream_key)
+        pipe.xlen(stream_key)
+        exists, length = await pipe.execute()
+
+    groups = await redis_conn.xinfo_groups(stream_key) if exists else []
+    return {
+        "transport": INSTRUCTION_TRANSPORT,
+        "length": length,
+        "groups": [
+            {
+                "name": group['name'].decode(),
+                "consumers": group['consumers'],
+                "pending": group['pending'],
+                "last_delivered_id": group['last-delivered-id'].decode(),
+                "lag": group.get('lag')
+            }
+            for group in groups
+        ]
+    }
+
+async def receive_instructions(timeout=0, max_items=1, session_id=DEFAULT_SESSION, group=STREAM_GROUP, consumer=DEFAULT_CONSUMER, recover=False):
+    if INSTRUCTION_TRANSPORT == "stream":
+        return await read_stream(timeout, max_items, session_id, group, consumer, recover)
+    return await pop_instructions(timeout, max_items, session_id)
+
+async def release_instructions(instructions, session_id=DEFAULT_SESSION):
+    # undelivered stream entries stay pending, the consumer gets them back with recover or another one claims them
+    if INSTRUCTION_TRANSPORT != "stream":
+        return await requeue_instructions(instructions, session_id)
+
+    instruction_ids = [instruction['id'] for instruction in instructions if instruction.get('id')]
+    if instruction_ids:
+        async with redis_conn.pipeline(transaction=False) as pipe:
+            for instruction_id in instruction_ids:
+                pipe.lrem(session_key('awaiting_ack', session_id), 1, instruction_id)
+            await pipe.execute()
+
+async def get_scene_state(session_id=DEFAULT_SESSION):
+    response = await redis_conn.get(session_key('response', session_id))
+    return {"response": json.loads(response) if response else ""}
+
+async def record_unity_response(response_params, session_id=DEFAULT_SESSION, group=STREAM_GROUP):
+    # resolve the instruction this response belongs to, without an id it is the oldest delivered one
+    awaiting_key = session_key('awaiting_ack', session_id)
+    instruction_id = response_params['instruction_id']
+    given_id = bool(instruction_id)
+    if not given_id:
+        instruction_id = await redis_conn.lpop(awaiting_key)
+        instruction_id = instruction_id.decode() if instruction_id else None
+
+    if instruction_id:
+        response_params['instruction_id'] = instruction_id
+
+    # the instructions folded into this one are answered by the same response
+    folded_ids = []
+    if instruction_id and COALESCE_INSTRUCTIONS:
+        folded_ids = [folded_id.decode() for folded_id in await redis_conn.lrange(f"merged:{instruction_id}", 0, -1)]
+
+    # the stream entry of the instruction stops being pending for the group that applied it
+    entry_id = None
+    if instruction_id and INSTRUCTION_TRANSPORT == "stream":
+        entry_id = await redis_conn.hget(stream_keys(session_id)['entries'], instruction_id)
+
+    # ack, scene state and push notification in one round trip
+    with redis_span("ack"):
+        async with redis_conn.pipeline(transaction=False) as pipe:
+            if instruction_id:
+                ack_key = f"ack:{instruction_id}"
+                if given_id:
+                    pipe.lrem(awaiting_key, 1, instruction_id)
+                pipe.rpush(ack_key, json.dumps(response_params))
+                pipe.expire(ack_key, ACK_TTL)
+
+            for folded_id in folded_ids:
+                pipe.rpush(f"ack:{folded_id}", json.dumps({**response_params, "instruction_id": folded_id}))
+                pipe.expire(f"ack:{folded_id}", ACK_TTL)
+            if folded_ids:
+                pipe.delete(f"merged:{instruction_id}")
+
+            if entry_id:
+                pipe.xack(stream_keys(session_id)['stream'], group, entry_id)
+                pipe.hdel(stream_keys(session_id)['entries'], instruction_id)
+                pipe.hdel(stream_keys(session_id)['instructions'], entry_id)
+
+            pipe.set(session_key('response', session_id), json.dumps(response_params))
+
+            # notify the push subscribers
+            pipe.publish(session_key('unity_response', session_id), json.dumps(response_params))
+            await pipe.execute()
+
+    return {"response": response_params}
+
+def scene_keys(session_id):
+    # objects: id -> object, name:<name>: ids with that name, prefab:<type>: ids of that type, prefabs: spawnable prefabs
+    return {
+        "objects": session_key('scene:objects', session_id),
+        "prefabs": session_key('scene:prefabs', session_id),
+        "version": session_key('scene:version', session_id)
+    }
+
+def prefab_key(prefab, session_id):
+    return session_key(f'scene:prefab:{prefab.lower()}', session_id)
+
+def name_key(name, session_id):
+    # several objects can share a name, like several objects share a prefab
+    return session_key(f'scene:name:{name.lower()}', session_id)
+
+def index_object(pipe, keys, scene_object, session_id):
+    pipe.hset(keys["objects"], scene_object["id"], json.dumps(scene_object))
+    pipe.sadd(name_key(scene_object["name"], session_id), scene_object["id"])
+    pipe.sadd(prefab_key(scene_object["prefab"], session_id), scene_object["id"])
+
+def unindex_object(pipe, keys, scene_object, session_id):
+    pipe.hdel(keys["objects"], scene_object["id"])
+    pipe.srem(name_key(scene_object["name"], session_id), scene_object["id"])
+    pipe.srem(prefab_key(scene_object["prefab"], session_id), scene_object["id"])
+
+async def write_scene(session_id, base_version, load, apply):
+    # optimistic transaction on the scene version: load reads what apply needs, apply queues the writes
+    keys = scene_keys(session_id)
+    for _ in range(SCENE_WRITE_RETRIES):
+        try:
+            async with redis_conn.pipeline(transaction=True) as pipe:
+                await pipe.watch(keys["version"])
+                version = int(await pipe.get(keys["version"]) or 0)
+                if base_version is not None and base_version != version:
+                    raise HTTPException(status_code=409, detail=f"Scene is at version {version}, send a snapshot.")
+
+                loaded = await load(pipe, keys)
+                pipe.multi()
+                result = apply(pipe, keys, loaded)
+                pipe.incr(keys["version"])
+                *_, new_version = await pipe.execute()
+                return {"version": new_version, **result}
+        except WatchError:
+            continue
+    raise HTTPException(status_code=409, detail="Scene is being updated, retry.")
+
+async def apply_scene_snapshot(snapshot, session_id=DEFAULT_SESSION):
+    async def load(pipe, keys):
+        return [json.loads(raw_object) for raw_object in (await pipe.hvals(keys["objects"]))]
+
+    def apply(pipe, keys, existing):
+        for scene_object in existing:
+            pipe.srem(name_key(scene_object["name"], session_id), scene_object["id"])
+            pipe.srem(prefab_key(scene_object["prefab"], session_id), scene_object["id"])
+        pipe.delete(keys["objects"], keys["prefabs"])
+        for scene_object in snapshot.objects:
+            index_object(pipe, keys, dict(scene_object), session_id)
+        if snapshot.available_prefabs:
+            pipe.sadd(keys["prefabs"], *snapshot.available_prefabs)
+        return {"objects": len(snapshot.objects)}
+
+    with redis_span("scene_snapshot"):
+        return await write_scene(session_id, None, load, apply)
+
+async def apply_scene_delta(delta, session_id=DEFAULT_SESSION):
+    object_ids = [scene_object.id for scene_object in delta.added] + [transform.id for transform in delta.moved] + delta.removed
+
+    async def load(pipe, keys):
+        if not object_ids:
+            return {}
+        raw_objects = await pipe.hmget(keys["objects"], object_ids)
+        return {object_id: json.loads(raw_object) for object_id, raw_object in zip(object_ids, raw_objects) if raw_object}
+
+    def apply(pipe, keys, current):
+        missing = []
+        for scene_object in delta.added:
+            # a re-added id may have a new name or prefab, drop its old index entries first
+            if scene_object.id in current:
+                unindex_object(pipe, keys, current[scene_object.id], session_id)
+            current[scene_object.id] = dict(scene_object)
+            index_object(pipe, keys, current[scene_object.id], session_id)
+
+        for transform in delta.moved:
+            if transform.id not in current:
+                missing.append(transform.id)
+                continue
+            for field in ("position", "rotation", "scale"):
+                if getattr(transform, field) is not None:
+                    current[transform.id][field] = getattr(transform, field)
+            pipe.hset(keys["objects"], transform.id, json.dumps(current[transform.id]))
+
+        for object_id in delta.removed:
+            if object_id not in current:
+                missing.append(object_id)
+                continue
+            unindex_object(pipe, keys, current.pop(object_id), session_id)
+
+        if delta.available_prefabs is not None:
+            pipe.delete(keys["prefabs"])
+            if delta.available_prefabs:
+                pipe.sadd(keys["prefabs"], *delta.available_prefabs)
+        return {"missing": missing}
+
+    with redis_span("scene_delta"):
+        return await write_scene(session_id, delta.base_version, load, apply)
+
+def distance(first, second):
+    return math.dist(first["position"], second["position"])
+
+async def query_scene_graph(session_id, name=None, prefab=None, near=None, limit=5):
+    keys = scene_keys(session_id)
+
+    if name is not None and near is None:
+        # both given: the objects with that name and of that prefab
+        if prefab is not None:
+            object_ids = list(await redis_conn.sinter(name_key(name, session_id), prefab_key(prefab, session_id)))
+        else:
+            object_ids = list(await redis_conn.smembers(name_key(name, session_id)))
+        raw_objects = await redis_conn.hmget(keys["objects"], object_ids) if object_ids else []
+    elif prefab is not None:
+        object_ids = list(await redis_conn.smembers(prefab_key(prefab, session_id)))
+        raw_objects = await redis_conn.hmget(keys["objects"], object_ids) if object_ids else []
+    else:
+        raw_objects = await redis_conn.hvals(keys["objects"])
+    objects = [json.loads(raw_object) for raw_object in raw_objects if raw_object]
+
+    if near is not None:
+        # the candidates closest to the reference object, the reference itself excluded,
+        # near is an object id or the name of a single object
+        reference = await redis_conn.hget(keys["objects"], near)
+        if reference is None:
+            reference_ids = list(await redis_conn.smembers(name_key(near, session_id)))
+            if len(reference_ids) > 1:
+                raise HTTPException(status_code=409, detail=f"Several objects are named {near}, use the object id.")
+            reference = await redis_conn.hget(keys["objects"], reference_ids[0]) if reference_ids else None
+        if reference is None:
+            raise HTTPException(status_code=404, detail=f"Reference object {near} not found.")
+        reference = json.loads(reference)
+        objects = sorted((scene_object for scene_object in objects if scene_object["id"] != reference["id"]), key=lambda scene_object: distance(scene_object, reference))
+        if name is not None:
+            objects = [scene_object for scene_object in objects if scene_object["name"].lower() == name.lower()]
+
+    return objects[:limit]
+
+@app.post("/set/spawn")
+async def set_spawn(spawn_obj: SpawnObject, session_id: str = DEFAULT_SESSION):
+    spawn_params = dict(spawn_obj)
+    print(type(spawn_obj))
+    check_parameters("spawn", spawn_params)
+    return await push_instruction("spawn", spawn_params, session_id)
+
+@app.post("/set/snap")
+async def set_snap(snap_obj: SnapObject, session_id: str = DEFAULT_SESSION):
+    snap_params = dict(snap_obj)
+    return await push_instruction("snap", snap_params, session_id)
+
+@app.post("/set/move")
+async def set_move(move_obj: MoveObject, session_id: str = DEFAULT_SESSION):
+    move_params = dict(move_obj)
+    check_parameters("move", move_params)
+    return await push_instruction("move", move_params, session_id)
+
+@app.post("/set/remove")
+async def set_remove(remove_obj: RemoveObject, session_id: str = DEFAULT_SESSION):
+    remove_params = dict(remove_obj)
+
+    return await push_instruction("remove", remove_params, session_id)
+
+@app.post("/set/replace")
+async def set_replace(replace_obj: ReplaceObject, session_id: str = DEFAULT_SESSION):
+    replace_params = dict(replace_obj)
+    return await push_instruction("replace", replace_params, session_id)
+
 @app.post("/set/scale")
-async def set_scale(scale_obj: ScaleObject):
+async def set_scale(scale_obj: ScaleObject, session_id: str = DEFAULT_SESSION):
     scale_params = dict(scale_obj)
-    if scale_params['axis'].lower() not in scaleList:
-        raise HTTPException(status_code=400, detail=f"Axis is invalid. {scaleList}")
-    elif not scale_params['value'].isdigit():
-        raise HTTPException(status_code=400, detail="Value should be a number.")
-    else:
-        currentInstruction['action'] = "scale"
-        currentInstruction['parameters'] = scale_params
-        
-        try:
-            redis_conn.rpush('instruction', json.dumps(currentInstruction))
-            return {
-                "success": True,
-                "message": "Pushed to Redis Queue",
-                "payload": currentInstruction
-            }
-        except Exception as e:
-            return {
-                "success": False,
-                "error": str(e)
-            }
+    check_parameters("scale", scale_params)
+    return await push_instruction("scale", scale_params, session_id)
 
 @app.post("/set/rotate")
-async def set_rotate(rotate_obj: RotateObject):
+async def set_rotate(rotate_obj: RotateObject, session_id: str = DEFAULT_SESSION):
     rotate_params = dict(rotate_obj)
-    if rotate_params['axis'].lower() not in axisList:
-        raise HTTPException(status_code=400, detail=f"Axis is invalid. {axisList}")
-    elif not rotate_params['value'].isdigit():
-        raise HTTPException(status_code=400, detail="Value should be a number.")
-    else:
-        currentInstruction['action'] = "rotate"
-        currentInstruction['parameters'] = rotate_params
-        
+    check_parameters("rotate", rotate_params)
+    return await push_instruction("rotate", rotate_params, session_id)
+
+@app.post("/set/batch")
+async def set_batch(batch_obj: InstructionBatch, session_id: str = DEFAULT_SESSION):
+    if not batch_obj.instructions:
+        raise HTTPException(status_code=400, detail="No instructions given.")
+
+    instructions = []
+    for index, instruction in enumerate(batch_obj.instructions):
+        if instruction.action not in instruction_models:
+            raise HTTPException(status_code=400, detail=f"Instruction {index}: action is invalid. {list(instruction_models)}")
         try:
-            redis_conn.rpush('instruction', json.dumps(currentInstruction))
-            return {
-                "success": True,
-                "message": "Pushed to Redis Queue",
-                "payload": currentInstruction
-            }
-        except Exception as e:
-            return {
-                "success": False,
-                "error": str(e)
-            }
+            parameters = dict(instruction_models[instruction.action](**instruction.parameters))
+        except ValidationError as e:
+            fields = ", ".join(str(error['loc'][0]) for error in e.errors())
+            raise HTTPException(status_code=400, detail=f"Instruction {index}: invalid or missing {fields}.")
+
+        check_parameters(instruction.action, parameters)
+        instructions.append((instruction.action, parameters))
+
+    return await push_instructions(instructions, session_id)
 
 @app.post("/set/response")
-async def set_response(response_obj: UnityResponseObject):
+async def set_response(response_obj: UnityResponseObject, session_id: str = DEFAULT_SESSION, group: str = STREAM_GROUP):
     response_params = dict(response_obj)
-    responseFromUnity['response'] = response_params
-    return responseFromUnity
+    return await record_unity_response(response_params, session_id, group)
 
 @app.get("/response")
-async def get_response():
-    return responseFromUnity
+async def get_response(session_id: str = DEFAULT_SESSION):
+    return await get_scene_state(session_id)
+
+@app.get("/response/{instruction_id}")
+async def get_instruction_response(instruction_id: str, timeout: int = 10):
+    # long-poll until Unity answers the given instruction, a zero timeout would block forever
+    timeout = min(max(timeout, 1), ACK_TTL)
+    result = await redis_conn.blpop(f"ack:{instruction_id}", timeout)
+    if result is None:
+        raise HTTPException(status_code=408, detail="No response from Unity yet.")
+
+    return {"response": json.loads(result[1])}
 
 @app.get("/instruction")
-async def get_instruction():
+async def get_instruction(timeout: int = 0, max_items: Optional[int] = None, session_id: str = DEFAULT_SESSION,
+                          group: str = STREAM_GROUP, consumer: str = DEFAULT_CONSUMER, recover: bool = False):
+    # without max_items a single instruction is returned, as the Unity client expects,
+    # group, consumer and recover only apply to the stream transport
+    timeout = min(max(timeout, 0), MAX_POLL_TIMEOUT)
+    count = min(max(max_items or 1, 1), MAX_POLL_ITEMS)
+
     try:
-        return json.loads(redis_conn.lpop("instruction"))
+        instructions = await receive_instructions(timeout, count, session_id, group, consumer, recover)
     except Exception as e:
         return {
             "success": False,
             "error": str(e)
         }
 
+    if max_items is None:
+        if instructions:
+            return instructions[0]
+        return {
+            "success": False,
+            "error": "No instruction available."
+        }
+
+    return {
+        "success": True,
+        "instructions": instructions
+    }
+
+@app.get("/instruction/replay")
+async def get_instruction_replay(since: Optional[str] = None, count: int = MAX_POLL_ITEMS, session_id: str = DEFAULT_SESSION):
+    # the instructions after the stream id since, from the start of the stream without it
+    if INSTRUCTION_TRANSPORT != "stream":
+        raise HTTPException(status_code=400, detail="Replay needs INSTRUCTION_TRANSPORT=stream.")
+    instructions = await replay_stream(since, min(max(count, 1), MAX_POLL_ITEMS), session_id)
+    return {
+        "success": True,
+        "instructions": instructions,
+        "next": instructions[-1]['stream_id'] if instructions else since
+    }
+
+@app.post("/instruction/ack")
+async def ack_instructions(stream_ids: List[str] = Body(..., embed=True), session_id: str = DEFAULT_SESSION, group: str = STREAM_GROUP):
+    # for observers, the Unity group is acknowledged by its responses
+    if INSTRUCTION_TRANSPORT != "stream":
+        raise HTTPException(status_code=400, detail="Acknowledgements need INSTRUCTION_TRANSPORT=stream.")
+    return {"success": True, "acknowledged": await ack_stream(stream_ids, session_id, group)}
+
+@app.post("/instruction/group")
+async def set_instruction_group(group: str, start_id: str = "$", session_id: str = DEFAULT_SESSION):
+    if INSTRUCTION_TRANSPORT != "stream":
+        raise HTTPException(status_code=400, detail="Consumer groups need INSTRUCTION_TRANSPORT=stream.")
+    try:
+        return await set_stream_group(group, start_id, session_id)
+    except ResponseError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/instruction/stream")
+async def get_instruction_stream(session_id: str = DEFAULT_SESSION):
+    return await get_stream_info(session_id)
+
+@app.websocket("/ws/instruction")
+async def instruction_socket(websocket: WebSocket, max_items: int = 10, session_id: str = DEFAULT_SESSION,
+                             group: str = STREAM_GROUP, consumer: str = DEFAULT_CONSUMER):
+    # pushes instructions to a Unity client as soon as they are queued,
+    # the client may send its UnityResponseObject back on the same socket
+    await websocket.accept()
+    count = min(max(max_items, 1), MAX_POLL_ITEMS)
+    disconnected = asyncio.Event()
+
+    async def receive_responses():
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("text"):
+                    try:
+                        response_params = dict(UnityResponseObject(**json.loads(message["text"])))
+                        await record_unity_response(response_params, session_id, group)
+                    except Exception as e:
+                        print(f"Invalid Unity response: {e}")
+        finally:
+            disconnected.set()
+
+    receiver = asyncio.create_task(receive_responses())
+
+    # a reconnecting client first gets the instructions it never acknowledged
+    recover = True
+
+    try:
+        while not disconnected.is_set():
+            instructions = await receive_instructions(STREAM_POLL_TIMEOUT, count, session_id, group, consumer, recover)
+            recover = False
+
+            for index, instruction in enumerate(instructions):
+                if disconnected.is_set():
+                    await release_instructions(instructions[index:], session_id)
+                    break
+                try:
+                    await websocket.send_json(instruction)
+                except Exception:
+                    await release_instructions(instructions[index:], session_id)
+                    disconnected.set()
+                    break
+    finally:
+        receiver.cancel()
+
+def enqueue_prompt(prompt, session_id):
+    # the function is resolved by name on the worker, the api does not import the llm code
+    return task_queue.enqueue(
+        "jobs.process_prompt",
+        prompt,
+        session_id,
+        job_timeout=PROMPT_JOB_TIMEOUT,
+        result_ttl=PROMPT_RESULT_TTL,
+        failure_ttl=PROMPT_RESULT_TTL,
+        retry=Retry(max=PROMPT_JOB_RETRIES) if PROMPT_JOB_RETRIES > 0 else None
+    )
+
+def get_prompt_job(job_id):
+    try:
+        job = Job.fetch(job_id, connection=rq_conn)
+    except NoSuchJobError:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    status = job.get_status(refresh=False)
+    result = {
+        "job_id": job.id,
+        "status": status.value if hasattr(status, "value") else status,
+        "position": job.get_position(),
+        "enqueued_at": job.enqueued_at.isoformat() if job.enqueued_at else None,
+        "ended_at": job.ended_at.isoformat() if job.ended_at else None,
+        "timings": job.meta.get("timings")
+    }
+    if job.is_finished:
+        result["result"] = job.return_value()
+    if job.is_failed:
+        result["error"] = job.exc_info.strip().splitlines()[-1] if job.exc_info else "Job failed."
+    return result
+
+@app.post("/set/prompt")
+async def set_prompt(prompt_obj: UserPrompt):
+    # queued for the llm workers, the caller polls GET /prompt/{job_id} for the result
+    job = await run_in_threadpool(enqueue_prompt, prompt_obj.prompt, prompt_obj.session_id)
+    return {
+        "success": True,
+        "message": "Prompt queued",
+        "job_id": job.id
+    }
+
+@app.get("/prompt/{job_id}")
+async def get_prompt(job_id: str):
+    return await run_in_threadpool(get_prompt_job, job_id)
+
+@app.post("/scene")
+async def set_scene(snapshot: SceneSnapshot, session_id: str = DEFAULT_SESSION):
+    # replaces the whole scene graph, used on scene load and after a rejected delta
+    return await apply_scene_snapshot(snapshot, session_id)
+
+@app.post("/scene/delta")
+async def set_scene_delta(delta: SceneDelta, session_id: str = DEFAULT_SESSION):
+    return await apply_scene_delta(delta, session_id)
+
+@app.get("/scene")
+async def get_scene(session_id: str = DEFAULT_SESSION, since_version: Optional[int] = None):
+    # with since_version an unchanged scene is answered without its objects
+    keys = scene_keys(session_id)
+    version = int(await redis_conn.get(keys["version"]) or 0)
+    if since_version is not None and since_version == version:
+        return {"version": version, "changed": False}
+
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.get(keys["version"])
+        pipe.hvals(keys["objects"])
+        pipe.smembers(keys["prefabs"])
+        version, raw_objects, prefabs = await pipe.execute()
+
+    return {
+        "version": int(version or 0),
+        "changed": True,
+        "objects": [json.loads(raw_object) for raw_object in raw_objects],
+        "available_prefabs": sorted(prefab.decode() for prefab in prefabs)
+    }
+
+@app.get("/scene/query")
+async def get_scene_query(name: Optional[str] = None, prefab: Optional[str] = None, near: Optional[str] = None, available: Optional[str] = None, limit: int = 5, session_id: str = DEFAULT_SESSION):
+    # by name, by prefab type, nearest to a reference object (optionally of one prefab type) and spawnable prefabs
+    keys = scene_keys(session_id)
+    limit = min(max(limit, 1), MAX_SCENE_QUERY_ITEMS)
+    result = {"version": int(await redis_conn.get(keys["version"]) or 0)}
+
+    if available is not None:
+        # prefab names are kept as Unity sends them, the query ignores case like the name and prefab lookups
+        prefabs = await redis_conn.smembers(keys["prefabs"])
+        result["available"] = available.lower() in {prefab.decode().lower() for prefab in prefabs}
+    if name is not None or prefab is not None or near is not None:
+        result["objects"] = await query_scene_graph(session_id, name, prefab, near, limit)
+
+    return result
+
+@app.get("/events/response")
+async def response_events(request: Request, session_id: str = DEFAULT_SESSION):
+    # server-sent events with every Unity response, starting with the latest one
+    pubsub = pubsub_conn.pubsub(ignore_subscribe_messages=True)
+    try:
+        await pubsub.subscribe(session_key('unity_response', session_id))
+    except RedisConnectionError as e:
+        await pubsub.aclose()
+        raise HTTPException(status_code=503, detail=f"No subscription available: {e}")
+
+    async def event_stream():
+        try:
+            scene_state = await get_scene_state(session_id)
+            if scene_state['response']:
+                yield f"data: {json.dumps(scene_state['response'])}\n\n"
+
+            while not await request.is_disconnected():
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=STREAM_POLL_TIMEOUT)
+                if message is not None:
+                    data = message['data'].decode() if isinstance(message['data'], bytes) else message['data']
+                    yield f"data: {data}\n\n"
+        finally:
+            await pubsub.aclose()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.get("/coalesce/stats")
+async def coalesce_stats(session_id: str = DEFAULT_SESSION):
+    return await get_coalesce_stats(session_id)
+
+@app.get("/metrics")
+async def get_metrics():
+    # gunicorn workers write their samples to PROMETHEUS_MULTIPROC_DIR, the scrape merges them
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
 @app.post("/set/llm_status")
 async def set_llm_status(status_request: StatusRequest):
-    global llmStatus
+    # kept in Redis so every API worker reports the same status
     llmStatus = status_request.status
+    await redis_conn.set('llm_status', json.dumps(llmStatus))
+    if status_request.startup is not None:
+        await redis_conn.set('llm_startup', json.dumps(status_request.startup))
     return {"message": "Status updated", "status": llmStatus}
 
 @app.get("/llm_status")
 async def get_llm_status():
-    return {"llmStatus": llmStatus}
+    llmStatus, llmStartup = await redis_conn.mget('llm_status', 'llm_startup')
+    return {
+        "llmStatus": json.loads(llmStatus) if llmStatus else False,
+        "startup": json.loads(llmStartup) if llmStartup else None
+    }
+
+@app.on_event("shutdown")
+async def shutdown():
+    await redis_conn.aclose()
+    await redis_pool.disconnect()
+    await pubsub_conn.aclose()
+    await pubsub_pool.disconnect()
@@ -0,0 +1,301 @@
+import argparse
+import asyncio
+import functools
+import importlib.util
+import inspect
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+import uvicorn
+
+# replays a prompt corpus against /set/prompt of the llm service and reports per-stage timings,
+# latency percentiles and throughput for several concurrency levels
+# the api, the llm service and a stub Unity client run in this process on an in-memory or local Redis,
+# the llm service runs a tiny random-weight model built from the checkpoint tokenizer so no download is needed
+# usage: python bench.py --concurrency 1 4 8 --requests 64 --output report.json
+#        python bench.py --baseline report.json --max-regression 0.2
+
+server_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description="Benchmark the prompt-to-instruction path.")
+parser.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus.json"), help="scene and prompts to replay")
+parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8], help="concurrent clients per run")
+parser.add_argument("--requests", type=int, default=64, help="prompts sent per concurrency level")
+parser.add_argument("--warmup", type=int, default=4, help="prompts sent before measuring")
+parser.add_argument("--redis", default="fake", choices=["fake", "local"], help="in-memory fakeredis or the Redis at REDIS_HOST")
+parser.add_argument("--model", default=None, help="model snapshot to serve instead of the tiny random-weight model")
+parser.add_argument("--tokenizer", default=os.path.join(server_dir, "llm/model/tinyllama-instruct-tuned/checkpoint-60080/"), help="tokenizer of the tiny model")
+parser.add_argument("--layers", type=int, default=2, help="layers of the tiny model")
+parser.add_argument("--hidden-size", type=int, default=64, help="hidden size of the tiny model")
+parser.add_argument("--seed", type=int, default=0, help="seed of the tiny model weights")
+parser.add_argument("--env", nargs="*", default=[], help="llm service settings, KEY=VALUE")
+parser.add_argument("--api-port", type=int, default=18008)
+parser.add_argument("--llm-port", type=int, default=18009)
+parser.add_argument("--output", default=None, help="write the report as json")
+parser.add_argument("--baseline", default=None, help="report to compare against, exits with 1 on a regression")
+parser.add_argument("--max-regression", type=float, default=0.2, help="allowed p95 latency increase over the baseline")
+args = parser.parse_args()
+
+# random weights never produce valid JSON when sampling, the constrained decoder always does,
+# the rule-based extractor and the response cache are off so every prompt reaches the model
+llm_settings = {
+    "DECODING_MODE": "constrained",
+    "SLOT_EXTRACTOR": "false",
+    "RESPONSE_CACHE": "false",
+    "ROUTER_MODE": "keyword"
+}
+
+percentiles = [50, 95, 99]
+
+
+def build_tiny_model(tokenizer_path, output_path, layers, hidden_size, seed):
+    import torch
+    from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM
+
+    print(f"Building tiny model in {output_path}...")
+    torch.manual_seed(seed)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=layers,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=2048,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id
+    )
+    LlamaForCausalLM(config).save_pretrained(output_path, safe_serialization=True)
+    tokenizer.save_pretrained(output_path)
+
+
+def load_service(name, path):
+    # both services are called main, load them under their own names
+    service_dir = os.path.dirname(path)
+    if service_dir not in sys.path:
+        sys.path.insert(0, service_dir)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def serve(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def time_redis_push(api, samples):
+    # records how long the api spends queueing instructions in Redis
+    def timed(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*func_args, **func_kwargs):
+                start_time = time.perf_counter()
+                try:
+                    return await func(*func_args, **func_kwargs)
+                finally:
+                    samples.append(time.perf_counter() - start_time)
+        else:
+            @functools.wraps(func)
+            def wrapper(*func_args, **func_kwargs):
+                start_time = time.perf_counter()
+                try:
+                    return func(*func_args, **func_kwargs)
+                finally:
+                    samples.append(time.perf_counter() - start_time)
+        return wrapper
+
+    api.push_instruction = timed(api.push_instruction)
+    api.push_instructions = timed(api.push_instructions)
+
+
+def parse_server_timing(header):
+    stages = {}
+    for entry in filter(None, (part.strip() for part in (header or "").split(","))):
+        name, _, duration = entry.partition(";dur=")
+        stages[name] = float(duration) / 1000
+    return stages
+
+
+def percentile(values, rank):
+    if not values:
+        return None
+    values = sorted(values)
+    # nearest rank
+    return values[max(0, math.ceil(rank / 100 * len(values)) - 1)]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) * 1000 if values else None,
+        **{f"p{rank}_ms": percentile(values, rank) * 1000 if values else None for rank in percentiles}
+    }
+
+
+async def stub_unity(client, api_url, session_id, scene, stop):
+    # answers every instruction of the session with the unchanged scene
+    while not stop.is_set():
+        response = await client.get(api_url + "instruction", params={"timeout": 1, "max_items": 100, "session_id": session_id})
+        for instruction in response.json().get("instructions", []):
+            await client.post(
+                api_url + "set/response",
+                json={**scene, "message": f"{instruction['action']} done", "instruction_id": instruction["id"]},
+                params={"session_id": session_id}
+            )
+
+
+async def send_prompts(client, llm_url, session_id, prompts, results):
+    while prompts:
+        prompt = prompts.pop()
+        start_time = time.perf_counter()
+        try:
+            response = await client.post(llm_url + "set/prompt", json={"prompt": prompt, "session_id": session_id})
+            results.append({
+                "prompt": prompt,
+                "ok": response.status_code == 200,
+                "latency": time.perf_counter() - start_time,
+                "stages": parse_server_timing(response.headers.get("server-timing"))
+            })
+        except httpx.HTTPError as e:
+            print(f"Error sending prompt: {e}")
+            results.append({"prompt": prompt, "ok": False, "latency": time.perf_counter() - start_time, "stages": {}})
+
+
+async def run_level(api_url, llm_url, scene, corpus, concurrency, request_count, warmup, redis_samples, run_id):
+    async with httpx.AsyncClient(timeout=120.0) as client:
+        sessions = [f"bench-{run_id}-{concurrency}-{index}" for index in range(concurrency)]
+        stop = asyncio.Event()
+        await asyncio.gather(*[client.post(api_url + "set/response", json=scene, params={"session_id": session_id}) for session_id in sessions])
+        unity_tasks = [asyncio.create_task(stub_unity(client, api_url, session_id, scene, stop)) for session_id in sessions]
+
+        await send_prompts(client, llm_url, sessions[0], [corpus[index % len(corpus)] for index in range(warmup)], [])
+        redis_samples.clear()
+
+        prompts = [corpus[index % len(corpus)] for index in range(request_count)][::-1]
+        results = []
+        start_time = time.perf_counter()
+        await asyncio.gather(*[send_prompts(client, llm_url, session_id, prompts, results) for session_id in sessions])
+        elapsed = time.perf_counter() - start_time
+
+        stop.set()
+        await asyncio.gather(*unity_tasks)
+
+    stage_names = sorted({name for result in results for name in result["stages"]})
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": sum(not result["ok"] for result in results),
+        "throughput_rps": len(results) / elapsed if elapsed else None,
+        "latency": summarize([result["latency"] for result in results]),
+        "stages": {
+            **{name: summarize([result["stages"][name] for result in results if name in result["stages"]]) for name in stage_names},
+            "redis_push": summarize(list(redis_samples))
+        }
+    }
+
+
+def print_level(level):
+    print(f"\nconcurrency {level['concurrency']}: {level['requests']} requests, {level['errors']} errors, {level['throughput_rps']:.2f} req/s")
+    print(f"{'stage':<12}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, summary in [*level["stages"].items(), ("total", level["latency"])]:
+        if not summary["count"]:
+            continue
+        print(f"{name:<12}{summary['count']:>8}" + "".join(f"{summary[key]:>10.2f}" for key in ("mean_ms", "p50_ms", "p95_ms", "p99_ms")))
+
+
+def compare(report, baseline, max_regression):
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in report["levels"]:
+        previous = baseline_levels.get(level["concurrency"])
+        if previous is None or not previous["latency"]["p95_ms"]:
+            continue
+        change = level["latency"]["p95_ms"] / previous["latency"]["p95_ms"] - 1
+        print(f"concurrency {level['concurrency']}: p95 {previous['latency']['p95_ms']:.2f}ms -> {level['latency']['p95_ms']:.2f}ms ({change:+.1%})")
+        if change > max_regression:
+            regressions.append(level["concurrency"])
+    return regressions
+
+
+def main():
+    with open(args.corpus) as corpus_file:
+        corpus = json.load(corpus_file)
+
+    model_dir = args.model
+    if model_dir is None:
+        model_dir = tempfile.mkdtemp(prefix="bench-model-")
+        build_tiny_model(args.tokenizer, model_dir, args.layers, args.hidden_size, args.seed)
+
+    api_url = f"http://127.0.0.1:{args.api_port}/"
+    llm_url = f"http://127.0.0.1:{args.llm_port}/"
+
+    # the environment wins over the .env files of the services
+    os.environ.update(llm_settings)
+    os.environ.update(dict(setting.split("=", 1) for setting in args.env))
+    os.environ.update({
+        "API_URL": api_url,
+        "MERGED_MODEL_PATH": model_dir,
+        "RESPONSE_CACHE_SHARED": "false"
+    })
+    if args.redis == "fake":
+        os.environ.setdefault("REDIS_HOST", "127.0.0.1")
+
+    api = load_service("api_main", os.path.join(server_dir, "api/main.py"))
+    if args.redis == "fake":
+        import fakeredis
+        api.redis_conn = fakeredis.FakeAsyncRedis()
+        api.pubsub_conn = api.redis_conn
+
+    redis_samples = []
+    time_redis_push(api, redis_samples)
+    serve(api.app, args.api_port)
+
+    # the llm service loads its model and reports its status to the api on import
+    llm = load_service("llm_main", os.path.join(server_dir, "llm/main.py"))
+    serve(llm.app, args.llm_port)
+
+    run_id = int(time.time())
+    report = {
+        "settings": {key: os.environ.get(key) for key in sorted({*llm_settings, *(setting.split("=", 1)[0] for setting in args.env)})},
+        "model": args.model or f"random llama, {args.layers} layers, hidden size {args.hidden_size}",
+        "redis": args.redis,
+        "levels": []
+    }
+
+    for concurrency in args.concurrency:
+        level = asyncio.run(run_level(
+            api_url, llm_url, corpus["scene"], corpus["prompts"],
+            concurrency, args.requests, args.warmup, redis_samples, run_id
+        ))
+        report["levels"].append(level)
+        print_level(level)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=4)
+        print(f"\nReport written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.max_regression)
+        if regressions:
+            print(f"p95 latency regressed by more than {args.max_regression:.0%} at concurrency {regressions}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+
+def padded_generate(model, tokenizer, generation_config):
+    # decoder-only models need the padding on the left so every prompt ends at the same position
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    def generate_batch(prompt_texts):
+        inputs = tokenizer(prompt_texts, return_tensors="pt", padding=True).to(model.device)
+        with torch.no_grad():
+            output = model.generate(**inputs, generation_config=generation_config)
+
+        # return the prompts together with their completions like the pipeline does
+        completions = tokenizer.batch_decode(output[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+        return [prompt_text + completion for prompt_text, completion in zip(prompt_texts, completions)]
+
+    return generate_batch
+
+
+# groups concurrent generation requests into a single padded generate call,
+# a batch is sent once it is full or the oldest request waited max_wait_ms,
+# no more requests than there are threads calling submit can ever share a batch, a single slot never waits
+class BatchScheduler:
+    def __init__(self, generate_batch, max_batch_size=4, max_wait_ms=20, max_concurrency=None):
+        self.generate_batch = generate_batch
+        self.max_batch_size = min(max_batch_size, max_concurrency or max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.stats = {
+            "batches": 0,
+            "requests": 0,
+            "failed_batches": 0,
+            "batch_sizes": {},
+            "total_wait": 0.0,
+            "total_generation": 0.0
+        }
+
+        self.worker = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self.worker.start()
+
+    def submit(self, prompt_text):
+        future = Future()
+        self.requests.put((prompt_text, future, time.time()))
+        return future.result()
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            prompt_texts = [prompt_text for prompt_text, _, _ in batch]
+
+            start_time = time.time()
+            try:
+                outputs = self.generate_batch(prompt_texts)
+            except Exception as e:
+                print(f"Error in batch generation: {e}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                with self.lock:
+                    self.stats["failed_batches"] += 1
+                continue
+
+            for (_, future, _), output in zip(batch, outputs):
+                future.set_result(output)
+
+            self._record(batch, start_time)
+
+    def _record(self, batch, start_time):
+        size = len(batch)
+        with self.lock:
+            self.stats["batches"] += 1
+            self.stats["requests"] += size
+            self.stats["batch_sizes"][size] = self.stats["batch_sizes"].get(size, 0) + 1
+            self.stats["total_wait"] += sum(start_time - queued_at for _, _, queued_at in batch)
+            self.stats["total_generation"] += time.time() - start_time
+
+        print(f"Batch generated: {size}/{self.max_batch_size} requests in {time.time() - start_time:.2f}s")
+
+    def report(self):
+        with self.lock:
+            batches = self.stats["batches"]
+            requests = self.stats["requests"]
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "batches": batches,
+                "requests": requests,
+                "failed_batches": self.stats["failed_batches"],
+                "batch_sizes": dict(self.stats["batch_sizes"]),
+                "mean_occupancy": requests / (batches * self.max_batch_size) if batches else 0.0,
+                "mean_wait_ms": self.stats["total_wait"] / requests * 1000 if requests else 0.0,
+                "mean_batch_duration": self.stats["total_generation"] / batches if batches else 0.0
+            }
@@ -0,0 +1,195 @@
+import torch
+
+# keep in sync with the lists in api/main.py
+directionsList = ["left", "right", "front", "back", "top", "bottom", "default"]
+axisList = ['x', 'y', 'z', 'reset', 'default']
+
+STRING = "string"
+NUMBER = "number"
+
+# fields follow the order of the few-shot examples in the chain templates,
+# a list value means the field is an enum
+action_schemas = {
+    "spawn": {
+        "prefab": STRING,
+        "reference_object": STRING,
+        "direction": directionsList,
+        "value": NUMBER
+    },
+    "move": {
+        "prefab": STRING,
+        "direction": directionsList,
+        "value": NUMBER
+    },
+    "replace": {
+        "prefab": STRING,
+        "object_to_replace": STRING
+    },
+    "rotate": {
+        "prefab": STRING,
+        "axis": axisList,
+        "value": NUMBER
+    },
+    "remove": {
+        "prefab": STRING
+    }
+}
+
+# value used when the model closes a number field without any digit
+DEFAULT_NUMBER = "1"
+
+
+# greedy decoder that fills the fixed JSON skeleton of an action schema
+# keys, quotes and separators are forced so the model only generates the values:
+# strings stop at the closing quote, numbers only use digit tokens and enums
+# are restricted to their allowed values, generation ends after the last value
+class ConstrainedDecoder:
+    def __init__(self, model, tokenizer, max_field_tokens=16, prefix_cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache
+        self.max_field_tokens = max_field_tokens
+        self._newline_ids = tokenizer.encode("\n", add_special_tokens=False)
+        self._build_vocab_masks()
+
+    def _build_vocab_masks(self):
+        vocab_size = self.model.config.vocab_size
+        special_ids = set(self.tokenizer.all_special_ids)
+        tokens = self.tokenizer.convert_ids_to_tokens(list(range(len(self.tokenizer))))
+
+        self.string_mask = torch.zeros(vocab_size, dtype=torch.bool)
+        self.number_mask = torch.zeros(vocab_size, dtype=torch.bool)
+        self.closing_mask = torch.zeros(vocab_size, dtype=torch.bool)
+        self.pieces = [""] * vocab_size
+
+        for token_id, token in enumerate(tokens[:vocab_size]):
+            # byte fallback tokens (newlines, control characters) and special tokens are never allowed
+            if token is None or token_id in special_ids or token.startswith("<0x"):
+                continue
+
+            piece = token.replace("\u2581", " ").replace("\u0120", " ")
+            self.pieces[token_id] = piece
+
+            if piece.startswith('"'):
+                self.closing_mask[token_id] = True
+            elif not any(char in piece for char in '"\\{}\n'):
+                self.string_mask[token_id] = True
+                if piece.isascii() and piece.isdigit():
+                    self.number_mask[token_id] = True
+
+    def _continuation_ids(self, text):
+        # encode text as a continuation so the tokenizer does not add a word-start prefix
+        ids = self.tokenizer.encode("\n" + text, add_special_tokens=False)
+        if ids[:len(self._newline_ids)] == self._newline_ids:
+            return ids[len(self._newline_ids):]
+        return ids
+
+    def _forward(self, ids, past_key_values):
+        with torch.no_grad():
+            output = self.model(
+                input_ids=torch.tensor([ids], device=self.model.device),
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+        return output.logits[0, -1].float().cpu(), output.past_key_values
+
+    @staticmethod
+    def _pick(logits, mask):
+        masked = logits[:mask.shape[0]].masked_fill(~mask, float("-inf"))
+        return int(torch.argmax(masked))
+
+    def _generate_text(self, logits, past_key_values, value_mask, on_text=None):
+        allowed = value_mask | self.closing_mask
+        token_ids = []
+
+        for _ in range(self.max_field_tokens):
+            token_id = self._pick(logits, allowed)
+            if self.closing_mask[token_id]:
+                break
+
+            token_ids.append(token_id)
+            if on_text is not None:
+                on_text(self.pieces[token_id])
+            logits, past_key_values = self._forward([token_id], past_key_values)
+
+        text = "".join(self.pieces[token_id] for token_id in token_ids).strip()
+        return text, past_key_values
+
+    def _generate_choice(self, logits, past_key_values, options):
+        sequences = {tuple(self._continuation_ids(option)): option for option in options}
+        prefix = ()
+
+        while True:
+            depth = len(prefix)
+            candidates = {sequence[depth] for sequence in sequences if sequence[:depth] == prefix and len(sequence) > depth}
+            complete = sequences.get(prefix)
+
+            # an option that is a prefix of another one ends when closing the quote is more likely
+            if complete is not None:
+                if not candidates:
+                    return complete, past_key_values
+                closing_logit = logits[:self.closing_mask.shape[0]].masked_fill(~self.closing_mask, float("-inf")).max()
+                if closing_logit >= max(logits[token_id] for token_id in candidates):
+                    return complete, past_key_values
+
+            token_id = max(candidates, key=lambda candidate: logits[candidate])
+            prefix += (token_id,)
+            logits, past_key_values = self._forward([token_id], past_key_values)
+
+    def _start(self, prompt_text):
+        # ids still to be fed to the model before the next value
+        if self.prefix_cache is not None:
+            prompt_ids, past_key_values, cached_length = self.prefix_cache.lookup(prompt_text)
+            return prompt_ids[cached_length:], past_key_values
+        return self.tokenizer.encode(prompt_text), None
+
+    def _fill(self, schema, pending, past_key_values, first_opening, separator, on_text=None):
+        parameters = {}
+
+        for index, (field, kind) in enumerate(schema.items()):
+            opening = first_opening if index == 0 else separator
+            pending = pending + self._continuation_ids(f'{opening}{field}": "')
+            if on_text is not None:
+                on_text(f'{opening}{field}": "')
+            logits, past_key_values = self._forward(pending, past_key_values)
+            pending = []
+
+            if isinstance(kind, list):
+                parameters[field], past_key_values = self._generate_choice(logits, past_key_values, kind)
+                if on_text is not None:
+                    on_text(parameters[field])
+            elif kind == NUMBER:
+                value, past_key_values = self._generate_text(logits, past_key_values, self.number_mask, on_text)
+                parameters[field] = value or DEFAULT_NUMBER
+            else:
+                parameters[field], past_key_values = self._generate_text(logits, past_key_values, self.string_mask, on_text)
+
+        return parameters, past_key_values
+
+    def generate(self, action, prompt_text, on_text=None):
+        pending, past_key_values = self._start(prompt_text)
+        parameters, _ = self._fill(action_schemas[action], pending, past_key_values, '{\n    "', '",\n    "', on_text)
+
+        if on_text is not None:
+            on_text('"\n}')
+
+        return {
+            "action": action,
+            "parameters": parameters
+        }
+
+    def generate_joint(self, prompt_text, on_text=None):
+        # one pass for the joint template: the action is an enum, its schema decides the parameters
+        pending, past_key_values = self._start(prompt_text)
+        action_field, past_key_values = self._fill({"action": list(action_schemas)}, pending, past_key_values, '{"', '", "', on_text)
+        action = action_field["action"]
+
+        parameters, _ = self._fill(action_schemas[action], [], past_key_values, '", "parameters": {"', '", "', on_text)
+
+        if on_text is not None:
+            on_text('"}}')
+
+        return {
+            "action": action,
+            "parameters": parameters
+        }
@@ -0,0 +1,38 @@
+import argparse
+import json
+import os
+import time
+
+from transformers import AutoTokenizer
+
+from model_loader import load_model
+
+# writes the merged fine-tuned model as a safetensors snapshot the service can load at boot
+# usage: python export_model.py --output ./model/merged --precision bf16
+
+parser = argparse.ArgumentParser(description="Export the merged LoRA model as a safetensors snapshot.")
+parser.add_argument("--base", default="TinyLlama/TinyLlama-1.1B-intermediate-step-240k-503b", help="base model name or path")
+parser.add_argument("--peft", default="./model/tinyllama-instruct-tuned/checkpoint-60080/", help="LoRA adapter checkpoint")
+parser.add_argument("--output", default="./model/merged", help="snapshot directory")
+parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16"], help="stored weight precision, int8 is applied when the service loads the snapshot")
+args = parser.parse_args()
+
+start_time = time.time()
+
+model = load_model(args.base, args.peft, precision=args.precision, merge=True)
+tokenizer = AutoTokenizer.from_pretrained(args.base)
+
+print(f"Saving snapshot to {args.output}...")
+os.makedirs(args.output, exist_ok=True)
+model.save_pretrained(args.output, safe_serialization=True)
+tokenizer.save_pretrained(args.output)
+
+with open(os.path.join(args.output, "export_info.json"), "w") as export_info:
+    json.dump({
+        "base_model": args.base,
+        "peft_model": args.peft,
+        "precision": args.precision,
+        "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }, export_info, indent=4)
+
+print(f"Export finished in {time.time() - start_time:.2f}s")
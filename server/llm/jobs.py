@@ -0,0 +1,42 @@
+import asyncio
+import json
+
+from rq import get_current_job
+
+import main
+from stage_timing import start_request
+
+# one event loop for every job of the worker, the http client of main stays bound to it
+loop = asyncio.new_event_loop()
+
+
+def save_dispatch(job, instruction_id):
+    # saved right away, a worker dying before the end of the job must not lose it
+    job.meta["dispatched"] = instruction_id
+    job.save_meta()
+
+
+async def run_prompt(prompt, session_id):
+    stages = start_request()
+    job = get_current_job()
+    try:
+        # a retry of a job that already queued its instruction only waits for Unity again
+        if job is not None and job.meta.get("dispatched"):
+            print(f"Job {job.id} already dispatched {job.meta['dispatched']}, not queueing it again")
+            return await main.wait_for_unity(job.meta["dispatched"], session_id)
+
+        if job is not None:
+            main.on_dispatch.set(lambda instruction_id: save_dispatch(job, instruction_id))
+        return await main.handle_prompt(prompt, session_id)
+    finally:
+        if job is not None:
+            job.meta["timings"] = {name: seconds * 1000 for name, seconds in stages.items()}
+            job.save_meta()
+
+
+# queued by POST /set/prompt of the api, the result is what the synchronous /set/prompt returns
+def process_prompt(prompt, session_id="default"):
+    result = loop.run_until_complete(run_prompt(prompt, session_id))
+    if isinstance(result, bytes):
+        result = json.loads(result)
+    return result
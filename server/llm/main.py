@@ -1,16 +1,34 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
 from langchain_huggingface.llms import HuggingFacePipeline
-from peft import PeftModel
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline, GenerationConfig
+from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline, GenerationConfig, TextStreamer
+from fastapi.responses import StreamingResponse
+import torch
 import json
 import requests
+import httpx
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 import os
 from dotenv import load_dotenv
 import time
+import string
+import re
+from constrained import ConstrainedDecoder
+from prefix_cache import PrefixCache
+from speculative import SpeculativeDecoder
+from batching import BatchScheduler, padded_generate
+from scene_index import SceneIndex, normalize_name
+from model_loader import PhaseTimer, load_model, load_exported
+from response_cache import ResponseCache
+from stage_timing import start_request, stage, in_context, server_timing
+from metrics import request_seconds, chain_seconds, generated_tokens, tokens_per_second, json_failures, routes, metrics_response
 
 # load .env 
 load_dotenv()
@@ -25,48 +43,227 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-
-# Load the base model
+# model settings
+# MODEL_PRECISION - fp32, bf16 or int8 (dynamic quantization)
+# MERGE_LORA - fold the adapter into the base weights instead of running it as a separate layer
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "fp32").lower()
+MERGE_LORA = os.getenv("MERGE_LORA", "true").lower() == "true"
+
+# snapshot written by export_model.py, loaded instead of the base model and adapter when present
+MERGED_MODEL_PATH = os.getenv("MERGED_MODEL_PATH", "/llm/app/model/merged/")
+
+# routing settings
+# keyword - skip the LLM router when the keyword match is confident
+# llm - always classify with the LLM router
+ROUTER_MODE = os.getenv("ROUTER_MODE", "keyword").lower()
+KEYWORD_CONFIDENCE = float(os.getenv("KEYWORD_CONFIDENCE", "1.0"))
+
+# decoding settings
+# sample - free sampling through the pipeline, parsed by get_json
+# constrained - greedy decoding constrained to the action schema
+DECODING_MODE = os.getenv("DECODING_MODE", "sample").lower()
+
+# pipeline settings
+# two_pass - the router picks the action, then the chain of that action fills the parameters
+# joint - one template returns the action and its parameters, used whenever the router would run
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "two_pass").lower()
+
+# reuse the past-key-values of the static template prefixes
+PREFIX_CACHE = os.getenv("PREFIX_CACHE", "true").lower() == "true"
+
+# assisted generation for the chains, decoded greedily and verified by the model so the output matches greedy decoding,
+# the chains sample without it, so turning it on also switches them from sampling to greedy decoding
+# off - plain pipeline generation
+# prompt_lookup - draft tokens copied from n-grams of the prompt
+# draft - draft tokens from the smaller model at DRAFT_MODEL_PATH, it has to share the tokenizer
+SPECULATIVE = os.getenv("SPECULATIVE", "off").lower()
+SPECULATIVE_DRAFT_TOKENS = int(os.getenv("SPECULATIVE_DRAFT_TOKENS", "8"))
+SPECULATIVE_NGRAM = int(os.getenv("SPECULATIVE_NGRAM", "3"))
+DRAFT_MODEL_PATH = os.getenv("DRAFT_MODEL_PATH", "")
+
+# threads running the blocking model calls, off the event loop
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+
+# how long to wait for Unity to acknowledge a dispatched instruction (seconds)
+RESPONSE_TIMEOUT = int(os.getenv("RESPONSE_TIMEOUT", "10"))
+
+# scene index used by the prompt validation, refreshed when no push update arrived within the ttl (seconds)
+SCENE_CACHE_TTL = float(os.getenv("SCENE_CACHE_TTL", "5"))
+SCENE_RECONNECT_DELAY = 5
+
+# where the scene index comes from
+# response - the comma-joined names of the Unity responses, pushed through /events/response
+# graph - the structured scene graph of the API, only fetched again when its version changed
+SCENE_SOURCE = os.getenv("SCENE_SOURCE", "response").lower()
+
+# subscribe to the pushed Unity responses, the job workers only run their event loop during a job and refresh instead
+SCENE_WATCH = os.getenv("SCENE_WATCH", "true").lower() == "true"
+
+# every watched session holds a stream and a Redis subscription on the API, the least recently used
+# watcher is stopped above SCENE_MAX_WATCHERS and unused ones after SCENE_WATCH_IDLE (seconds)
+SCENE_MAX_WATCHERS = int(os.getenv("SCENE_MAX_WATCHERS", "16"))
+SCENE_WATCH_IDLE = float(os.getenv("SCENE_WATCH_IDLE", "300"))
+
+# group concurrent chain calls into one padded generate call, a batch size of 1 disables batching
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "1"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "20"))
+
+# every request of a batch is waited on by its own inference thread, fewer threads than slots would never fill one
+if BATCH_MAX_SIZE > 1 and INFERENCE_WORKERS < BATCH_MAX_SIZE:
+    print(f"INFERENCE_WORKERS={INFERENCE_WORKERS} cannot fill batches of {BATCH_MAX_SIZE}, using {BATCH_MAX_SIZE} inference threads")
+    INFERENCE_WORKERS = BATCH_MAX_SIZE
+
+# cache of generated payloads in front of route, keyed on the normalized prompt and the scene vocabulary
+# RESPONSE_CACHE_SHARED - keep the entries in Redis so every LLM worker can use them
+# RESPONSE_CACHE_EMBEDDING_MODEL - sentence-transformers model for near-duplicate prompts, empty disables it
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "true").lower() == "true"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SHARED = os.getenv("RESPONSE_CACHE_SHARED", "true").lower() == "true"
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL", "")
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.92"))
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+
+# build the payload of simple commands from the keyword, scene names, direction/axis and number without the LLM
+SLOT_EXTRACTOR = os.getenv("SLOT_EXTRACTOR", "true").lower() == "true"
+
+keyword_categories = {
+    "spawn": ["spawn", "insert", "add", "put", "place"],
+    "move": ["move", "push", "displace", "offset"],
+    "replace": ["replace", "substitute"],
+    "rotate": ["rotate", "tilt", "turn"],
+    "remove": ["remove", "delete", "banish"]
+}
+
+router_stats = {
+    "keyword_hits": 0,
+    "keyword_misses": 0,
+    "ambiguous": 0,
+    "no_keyword": 0,
+    "llm_calls": 0,
+    "rule_hits": 0,
+    "rule_fallbacks": 0,
+    "joint_calls": 0
+}
+
+directions = ["left", "right", "front", "back", "top", "bottom"]
+axes = ["x", "y", "z"]
+
+# words the rule-based extractor cannot interpret, the LLM handles these prompts
+rule_stop_words = {"not", "don't", "dont", "never", "without", "except", "instead"}
+
+
+# Load the fine-tuned model
 base_model_name = "TinyLlama/TinyLlama-1.1B-intermediate-step-240k-503b"  # Replace with your base model name
-tokenizer = AutoTokenizer.from_pretrained(base_model_name)  
-
-print("Loading base model...")
-base_model = AutoModelForCausalLM.from_pretrained(base_model_name)
-print("Base model loaded.")
+peft_model_name = os.getenv("PEFT_MODEL_PATH", "/llm/app/model/tinyllama-instruct-tuned/checkpoint-60080/")
+startup_timer = PhaseTimer()
+
+if MERGED_MODEL_PATH and os.path.isdir(MERGED_MODEL_PATH):
+    # snapshot written by export_model.py, no hub download or adapter merge at boot
+    with startup_timer.phase("tokenizer"):
+        tokenizer = AutoTokenizer.from_pretrained(MERGED_MODEL_PATH)
+    with startup_timer.phase("model"):
+        model = load_exported(MERGED_MODEL_PATH, precision=MODEL_PRECISION)
+else:
+    with startup_timer.phase("tokenizer"):
+        tokenizer = AutoTokenizer.from_pretrained(base_model_name)
+    with startup_timer.phase("model"):
+        model = load_model(base_model_name, peft_model_name, precision=MODEL_PRECISION, merge=MERGE_LORA)
+
+generation_config = GenerationConfig(
+    penalty_alpha=0.6,
+    do_sample=True,
+    top_k=3,
+    temperature=0.5,
+    repetition_penalty=1.2,
+    max_new_tokens=64,
+    pad_token_id=tokenizer.eos_token_id
+)
 
 # Create a Hugging Face pipeline
-hf_pipeline = pipeline(
-    "text-generation",
-    model=base_model,
-    tokenizer=tokenizer,
-    generation_config = GenerationConfig(
-        penalty_alpha=0.6,
-        do_sample=True,
-        top_k=3,
-        temperature=0.5,
-        repetition_penalty=1.2,
-        max_new_tokens=64,
-        pad_token_id=tokenizer.eos_token_id
+with startup_timer.phase("pipeline"):
+    hf_pipeline = pipeline(
+        "text-generation",
+        model=model,
+        tokenizer=tokenizer,
+        generation_config = generation_config
     )
-)
 
-# Load the PEFT fine-tuned model
-peft_model_name = "/llm/app/model/tinyllama-instruct-tuned/checkpoint-60080/"
-
-print("Loading PEFT model...")
-pipeline.model = PeftModel.from_pretrained(base_model, peft_model_name)
-print("PEFT model loaded.")
-
-# Wrap the pipeline in LangChain's HuggingFacePipeline
-print("Wrapping in HuggingFacePipeline...")
-formatter = HuggingFacePipeline(pipeline=hf_pipeline)
-
-print("LLM Initiated")
-status_response = requests.post(os.getenv("API_URL") + '/set/llm_status', json={"status": True})
-print(status_response.json())
+    # Wrap the pipeline in LangChain's HuggingFacePipeline
+    print("Wrapping in HuggingFacePipeline...")
+    formatter = HuggingFacePipeline(pipeline=hf_pipeline)
+
+if PREFIX_CACHE:
+    # the templates are registered once they are defined below
+    prefix_cache = PrefixCache(model, tokenizer, generation_config)
+    formatter = RunnableLambda(lambda prompt_value: prefix_cache.generate(prompt_value.to_string()))
+else:
+    prefix_cache = None
+
+if SPECULATIVE in ("prompt_lookup", "draft"):
+    draft_model = None
+    if SPECULATIVE == "draft":
+        with startup_timer.phase("draft_model"):
+            draft_model = AutoModelForCausalLM.from_pretrained(DRAFT_MODEL_PATH, torch_dtype=torch.float32)
+            draft_model.eval()
+
+    print(f"Using speculative decoding ({SPECULATIVE})...")
+    speculative_decoder = SpeculativeDecoder(
+        model,
+        tokenizer,
+        generation_config,
+        num_draft_tokens=SPECULATIVE_DRAFT_TOKENS,
+        ngram_size=SPECULATIVE_NGRAM,
+        draft_model=draft_model,
+        prefix_cache=prefix_cache
+    )
+    formatter = RunnableLambda(lambda prompt_value: speculative_decoder.generate(prompt_value.to_string()))
+else:
+    speculative_decoder = None
+
+# one padded generate call for several prompts, used by the scheduler and compound prompts
+generate_batch = padded_generate(model, tokenizer, generation_config)
+
+if BATCH_MAX_SIZE > 1:
+    # batched calls share one generate call, the prefix cache is then only used by the constrained decoder and speculative decoding is skipped
+    print("Starting batch scheduler...")
+    batch_scheduler = BatchScheduler(
+        generate_batch,
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_MAX_WAIT_MS,
+        max_concurrency=INFERENCE_WORKERS
+    )
+    formatter = RunnableLambda(lambda prompt_value: batch_scheduler.submit(prompt_value.to_string()))
+else:
+    batch_scheduler = None
+
+if DECODING_MODE == "constrained":
+    print("Building constrained decoder...")
+    with startup_timer.phase("constrained_decoder"):
+        constrained_decoder = ConstrainedDecoder(model, tokenizer, prefix_cache=prefix_cache)
+
+inference_pool = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+http_client = httpx.AsyncClient(timeout=30.0)
+
+scene_index = SceneIndex(ttl=SCENE_CACHE_TTL)
+# session id -> (watch task, last use), least recently used first
+scene_watchers = OrderedDict()
+
+if RESPONSE_CACHE:
+    print("Starting response cache...")
+    with startup_timer.phase("response_cache"):
+        response_cache = ResponseCache(
+            max_entries=RESPONSE_CACHE_SIZE,
+            ttl=RESPONSE_CACHE_TTL,
+            redis_url=f"redis://{REDIS_HOST}:6379/0" if RESPONSE_CACHE_SHARED else None,
+            embedding_model=RESPONSE_CACHE_EMBEDDING_MODEL or None,
+            similarity=RESPONSE_CACHE_SIMILARITY
+        )
+else:
+    response_cache = None
 
 ## router
-router =  PromptTemplate.from_template(
+router_template = PromptTemplate.from_template(
     """Instruction:
 Classify the given sentence into either spawn, move, replace, rotate, or delete. 
 Here are the keywords for each classification
@@ -82,11 +279,12 @@ Input:
 
 Response:
 """
-) | formatter | StrOutputParser()
+)
+router = router_template | formatter | StrOutputParser()
 
 
 ## spawn chain
-spawn_chain = PromptTemplate.from_template(
+spawn_template = PromptTemplate.from_template(
     """Instruction:
 Format the given sentence and assign them to the proper parameter:
 here are the parameters and their description: 
@@ -109,10 +307,11 @@ Input:
 
 Response:
 """
-) | formatter
+)
+spawn_chain = spawn_template | formatter
 
 ## move chain
-move_chain = PromptTemplate.from_template(
+move_template = PromptTemplate.from_template(
     """Instruction:
 Format the given sentence and assign them to the proper parameter:
 here are the parameters and their description:
@@ -134,10 +333,11 @@ Input:
 
 Response:
 """
-) | formatter
+)
+move_chain = move_template | formatter
 
 ## replace chain
-replace_chain = PromptTemplate.from_template(
+replace_template = PromptTemplate.from_template(
     """Instruction:
 Format the given sentence and assign them to the proper parameter:
 here are the parameters and their description:
@@ -157,10 +357,11 @@ Input:
 
 Response:
 """
-) | formatter
+)
+replace_chain = replace_template | formatter
 
 ## rotate chain
-rotate_chain = PromptTemplate.from_template(
+rotate_template = PromptTemplate.from_template(
     """Instruction:
 Format them and sign them to the proper parameter:
 here are the parameters and their description:
@@ -182,10 +383,11 @@ Input:
 
 Response:
 """
-) | formatter
+)
+rotate_chain = rotate_template | formatter
 
 ## remove chain
-remove_chain = PromptTemplate.from_template(
+remove_template = PromptTemplate.from_template(
     """Instruction:
 Format them and sign them to the proper parameter:
 here are the parameters and their description: 
@@ -202,47 +404,308 @@ Input:
 
 Response:
 """
-) | formatter 
+)
+remove_chain = remove_template | formatter 
+
+## joint chain, classification and parameters in one pass
+joint_template = PromptTemplate.from_template(
+    """Instruction:
+Classify the given sentence into either spawn, move, replace, rotate, or remove and assign its parameters.
+Return only one line of valid json with the action and its parameters, use underscore and numbers on the names if there is any given.
+spawn - spawn, insert, add, put, place, or any synonyms to these words.
+    prefab - the object to be inserted/placed/spawned
+    reference_object - the object of reference, if there is no reference_object set the value to "default"
+    direction - either top, left, right, bottom, front, back, if there is no direction set the value to "default"
+    value - the displacement from the reference object, if there is no value set the value to 1
+move - move, push, displace, offset, or any synonyms to these words.
+    prefab - the object to be moved
+    direction - either top, left, right, bottom, front, back
+    value - how many units to be moved
+replace - replace, substitute, or any other synonyms to these words.
+    prefab - the object to be placed
+    object_to_replace - the object in the scene to be replaced
+rotate - rotate, tilt, turn, or any synonyms to these words
+    prefab - the object to be rotated
+    axis - either x, y, z or reset (to reset all axis)
+    value - how much degrees to rotate
+remove - remove, delete, banish or any other synonyms
+    prefab - the object to be deleted
+example sentence
+Move the workbench to the right.
+example output
+{{"action": "move", "parameters": {{"prefab": "workbench", "direction": "right", "value": "1"}}}}
+
+Input:
+{instruction}
+
+Response:
+"""
+)
+joint_chain = joint_template | formatter
+
+## template and chain lookup
+templates = {
+    "spawn": spawn_template,
+    "move": move_template,
+    "replace": replace_template,
+    "rotate": rotate_template,
+    "remove": remove_template
+}
+
+chains = {
+    "spawn": spawn_chain,
+    "move": move_chain,
+    "replace": replace_chain,
+    "rotate": rotate_chain,
+    "remove": remove_chain
+}
+
+def action_label(action):
+    # metric label for a generated action, free model output would add a series per spelling
+    return action if action in chains else "unknown"
+
+if prefix_cache is not None:
+    print("Caching template prefixes...")
+    with startup_timer.phase("prefix_cache"):
+        prefix_cache.warm([router_template, *templates.values(), *([joint_template] if PIPELINE_MODE == "joint" else [])])
+
+startup_report = startup_timer.report()
+
+print(f"LLM Initiated in {startup_report['total']:.2f}s")
+try:
+    status_response = requests.post(os.getenv("API_URL") + 'set/llm_status', json={"status": True, "startup": startup_report})
+    if status_response.status_code == 200:
+        print(status_response.json())
+    else:
+        print(f"Could not report the LLM status: {status_response.status_code} {status_response.text}")
+except requests.RequestException as e:
+    print(f"Could not report the LLM status: {e}")
+
+# the router prompt calls the remove action "delete"
+route_aliases = {
+    "delete": "remove"
+}
+
+# separators between the commands of a compound prompt
+command_separators = re.compile(r"(\s*(?:,|;|\band then\b|\bthen\b|\band\b)\s*)", re.IGNORECASE)
+
+## router selection
+def keyword_confident(category, confidence):
+    return ROUTER_MODE == "keyword" and category is not None and confidence >= KEYWORD_CONFIDENCE
+
+def parse_classification(classification_result):
+    if "Response:" in classification_result:
+        result = classification_result.split("Response:")[1].split()
+        if result:
+            action = result[0].lower()
+            return route_aliases.get(action, action)
+    return None
+
+def classify_route(prompt, category=None, confidence=0.0, on_event=None):
+    # keyword fast-path, only run the LLM router when the keyword match is missing or ambiguous
+    if keyword_confident(category, confidence):
+        router_stats["keyword_hits"] += 1
+        routes.labels("keyword", category).inc()
+        print(f'Route detected by keyword (confidence: {confidence:.2f})')
+        if on_event is not None:
+            on_event("classification", {"action": category, "source": "keyword", "confidence": confidence})
+        return category
+
+    router_stats["keyword_misses"] += 1
+    if category is not None:
+        router_stats["ambiguous"] += 1
 
-## routing function
-def route(prompt):
-    # url setup
-    url = os.getenv("API_URL")
-    
     print('Classifying route...')
-    classification_result = router.invoke(prompt)
+    router_stats["llm_calls"] += 1
+    with stage("router"):
+        classification_result = router.invoke(prompt)
     print('Route detected')
 
-    if "Response:" in classification_result:
-        result = classification_result.split("Response:")[1].strip()
-        action = result.split(' ')[0].lower()
+    action = parse_classification(classification_result)
+    routes.labels("llm", action_label(action)).inc()
+
+    if on_event is not None:
+        on_event("classification", {"action": action, "source": "llm", "confidence": confidence})
+    return action
+
+# forwards the decoded completion to a callback while generate runs
+class CallbackStreamer(TextStreamer):
+    def __init__(self, tokenizer, on_text):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.on_text = on_text
+
+    def on_finalized_text(self, text, stream_end=False):
+        if text:
+            self.on_text(text)
+
+def generate_chain_output(template, chain, prompt, on_event=None):
+    # batched calls are generated together, their completion is sent as a single event
+    if on_event is None or batch_scheduler is not None:
+        output = chain.invoke(prompt)
+        if on_event is not None:
+            on_event("token", {"text": output.split("Response:", 1)[-1]})
+        return output
+
+    prompt_text = template.format(instruction=prompt)
+    streamer = CallbackStreamer(tokenizer, lambda text: on_event("token", {"text": text}))
+
+    if speculative_decoder is not None:
+        return speculative_decoder.generate(prompt_text, streamer=streamer)
+
+    if prefix_cache is not None:
+        return prefix_cache.generate(prompt_text, streamer=streamer)
+
+    inputs = tokenizer(prompt_text, return_tensors="pt").to(model.device)
+    with torch.no_grad():
+        output = model.generate(**inputs, generation_config=generation_config, streamer=streamer)
+    return prompt_text + tokenizer.decode(output[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+
+def record_generation(action, completion, duration):
+    token_count = len(tokenizer.encode(completion, add_special_tokens=False))
+    chain_seconds.labels(action).observe(duration)
+    generated_tokens.labels(action).inc(token_count)
+    if duration > 0:
+        tokens_per_second.labels(action).observe(token_count / duration)
+
+def parse_joint(payload):
+    # the joint output has to name a known action and carry its parameters
+    if not isinstance(payload, dict) or not isinstance(payload.get("parameters"), dict):
+        return False, None
+    action = route_aliases.get(str(payload.get("action")).lower(), str(payload.get("action")).lower())
+    if action not in chains:
+        return False, None
+    return True, {"action": action, "parameters": payload["parameters"]}
+
+def joint_route(prompt, on_event=None):
+    print('Generating joint JSON...')
+    router_stats["joint_calls"] += 1
+
+    start_time = time.perf_counter()
+    if DECODING_MODE == "constrained":
+        if_parsed = True
+        on_text = (lambda text: on_event("token", {"text": text})) if on_event is not None else None
+        with stage("joint"):
+            payload = constrained_decoder.generate_joint(joint_template.format(instruction=prompt), on_text)
+        completion = json.dumps(payload)
+        print(f"JSON Output: {completion}")
+    else:
+        with stage("joint"):
+            output = generate_chain_output(joint_template, joint_chain, prompt, on_event)
+        completion = output.split("Response:", 1)[-1]
+        with stage("parse"):
+            if_parsed, payload = get_json(output) if "Response:" in output else (False, None)
+            if_parsed, payload = parse_joint(payload) if if_parsed else (False, None)
+        if not if_parsed:
+            json_failures.labels("joint").inc()
 
+    record_generation("joint", completion, time.perf_counter() - start_time)
+    action = payload["action"] if if_parsed else None
+    routes.labels("joint", action_label(action)).inc()
+
+    if on_event is not None:
+        on_event("classification", {"action": action, "source": "joint", "confidence": 1.0 if if_parsed else 0.0})
+        on_event("payload", {"parsed": if_parsed, "payload": payload})
+
+    return payload if if_parsed else None
+
+## routing function
+def route(prompt, category=None, confidence=0.0, on_event=None):
+    # the joint pipeline replaces the router and the chain, a confident keyword already needs only the chain
+    if PIPELINE_MODE == "joint" and not keyword_confident(category, confidence):
+        router_stats["keyword_misses"] += 1
+        return joint_route(prompt, on_event)
+
+    action = classify_route(prompt, category, confidence, on_event)
+
+    if action is not None:
         print('Action: ' + action)
 
         print('Generating JSON...')
 
-        if action == "spawn":
-            output = spawn_chain.invoke(prompt)
-        elif action == "move":
-            output = move_chain.invoke(prompt)
-        elif action == "replace":
-            output = replace_chain.invoke(prompt)
-        elif action == "rotate":
-            output = rotate_chain.invoke(prompt)
-        elif action == "remove":
-            output = remove_chain.invoke(prompt)
+        if action not in chains:
+            print("Error: Could not classify the instruction.")
+            return None
+
+        start_time = time.perf_counter()
+        if DECODING_MODE == "constrained":
+            # the schema guarantees valid JSON, no parsing needed
+            if_parsed = True
+            on_text = (lambda text: on_event("token", {"text": text})) if on_event is not None else None
+            with stage("chain", action=action):
+                payload = constrained_decoder.generate(action, templates[action].format(instruction=prompt), on_text)
+            record_generation(action, json.dumps(payload["parameters"]), time.perf_counter() - start_time)
+            print(f"JSON Output: {json.dumps(payload)}")
         else:
-            output = "Error: Could not classify the instruction."
+            with stage("chain", action=action):
+                output = generate_chain_output(templates[action], chains[action], prompt, on_event)
+            record_generation(action, output.split("Response:", 1)[-1], time.perf_counter() - start_time)
+            with stage("parse"):
+                if_parsed, payload = get_json(output) if "Response:" in output else (False, None)
+            if not if_parsed:
+                json_failures.labels(action).inc()
 
         print('JSON Generated')
+
+        if on_event is not None:
+            on_event("payload", {"parsed": if_parsed, "payload": payload})
         
-        if "Response:" in output:
-            if_parsed, payload = get_json(output)
-            if if_parsed:
-                route = f"set/{payload['action']}"
-                print(f"Route: {url}{route}")
-                response = requests.post(url+route, json=payload.get("parameters"))
-                return f"Type: Spawn\nResponse Code: {response.status_code}\nPayload:{payload}"
+        if if_parsed:
+            return payload
+
+    return None
+
+# called with the id of the queued instruction, the prompt jobs keep it so a retried job does not queue it again
+on_dispatch = contextvars.ContextVar("on_dispatch", default=None)
+
+def record_dispatch(instruction_id):
+    callback = on_dispatch.get()
+    if callback is not None and instruction_id is not None:
+        callback(instruction_id)
+
+async def dispatch(payload, session_id="default"):
+    # url setup
+    url = os.getenv("API_URL")
+
+    route = f"set/{payload['action']}"
+    print(f"Route: {url}{route}")
+    with stage("dispatch"):
+        response = await http_client.post(url+route, json=payload.get("parameters"), params={"session_id": session_id})
+    print(f"Type: {payload['action'].capitalize()}\nResponse Code: {response.status_code}\nPayload:{payload}")
+
+    # the id of the queued instruction, used to wait for the Unity response
+    if response.status_code == 200 and response.json().get("success"):
+        instruction_id = response.json()["payload"]["id"]
+        record_dispatch(instruction_id)
+        return instruction_id
+    return None
+
+async def wait_for_unity(instruction_id, session_id="default"):
+    with stage("unity_ack"):
+        return await wait_for_instruction(instruction_id, session_id)
+
+def failure_response(message):
+    # same shape as the Unity response, never the previous scene state
+    return json.dumps({"response": {"success": False, "message": message}}).encode()
+
+async def wait_for_instruction(instruction_id, session_id="default"):
+    url = os.getenv("API_URL")
+
+    if instruction_id is None:
+        return failure_response("The instruction could not be queued.")
+
+    try:
+        response = await http_client.get(
+            url + f"response/{instruction_id}",
+            params={"timeout": RESPONSE_TIMEOUT},
+            timeout=RESPONSE_TIMEOUT + 5
+        )
+        if response.status_code == 200:
+            return response.content
+        print(f"No Unity response for {instruction_id} after {RESPONSE_TIMEOUT}s")
+        return failure_response(f"Unity did not respond within {RESPONSE_TIMEOUT}s.")
+    except httpx.HTTPError as e:
+        print(f"Error waiting for Unity: {e}")
+        return failure_response("Could not reach the API while waiting for Unity.")
 
 def get_json(output):
     try: 
@@ -256,94 +719,426 @@ def get_json(output):
         print(pretty_json)
 
         return True, converted
-    except json.JSONDecodeError as e:
+    except (json.JSONDecodeError, IndexError) as e:
         print(f"Error decoding JSON: {e}")
-        return False
+        return False, None
         
-def full_invoke(prompt):
+def full_invoke(prompt, category=None, confidence=0.0, on_event=None):
     print('LLM Started')
     start_time = time.time()
-    response = route(prompt)
+    with stage("route"):
+        payload = route(prompt, category, confidence, on_event)
     print(f"LLM Duration: {time.time() - start_time}")
-    
-def check_keyword(prompt):
-    splitted_prompt = prompt.lower().split(' ')
-    
-    keyword_categories = {
-        "spawn": ["spawn", "insert", "add", "put", "place"],
-        "move": ["move", "push", "displace", "offset"],
-        "replace": ["replace", "substitute"],
-        "rotate": ["rotate", "tilt", "turn"],
-        "remove": ["remove", "delete", "banish"]
-    }
-    
+    return payload
+
+def lookup_response(prompt, vocabulary, on_event=None):
+    if response_cache is None:
+        return None
+
+    with stage("cache"):
+        payload = response_cache.get(prompt, vocabulary)
+    if payload is not None:
+        print(f"Response cache hit: {json.dumps(payload)}")
+        routes.labels("cache", action_label(payload["action"])).inc()
+        if on_event is not None:
+            on_event("payload", {"parsed": True, "payload": payload, "cached": True})
+    return payload
+
+def cached_invoke(prompt, vocabulary, category=None, confidence=0.0, on_event=None):
+    start_time = time.time()
+    payload = full_invoke(prompt, category, confidence, on_event)
+
+    # only parsed payloads are stored, a failed generation is retried next time
+    if payload is not None and response_cache is not None:
+        response_cache.put(prompt, payload, time.time() - start_time, vocabulary)
+    return payload
+
+async def invoke(prompt, category=None, confidence=0.0, session_id="default", on_event=None):
+    # simple commands are parsed directly, the model is the fallback
+    payload = rule_invoke(prompt, category, confidence, session_id, on_event)
+    if payload is not None:
+        return payload
+
+    loop = asyncio.get_running_loop()
+    vocabulary = scene_index.vocabulary(session_id)
+
+    # the lookup does not wait behind a running generation on the inference pool
+    payload = await loop.run_in_executor(None, in_context(lookup_response, prompt, vocabulary, on_event))
+    if payload is not None:
+        return payload
+
+    # run the blocking generation on the inference pool so the event loop keeps serving
+    return await loop.run_in_executor(inference_pool, in_context(cached_invoke, prompt, vocabulary, category, confidence, on_event))
+
+def route_batch(commands, categories, confidences):
+    # classify and extract every sub-command of a compound prompt with one generate call per stage
+    actions = []
+    for category, confidence in zip(categories, confidences):
+        if keyword_confident(category, confidence):
+            router_stats["keyword_hits"] += 1
+            routes.labels("keyword", category).inc()
+            actions.append(category)
+        else:
+            router_stats["keyword_misses"] += 1
+            actions.append(None)
+
+    unrouted = [index for index, action in enumerate(actions) if action is None]
+    payloads = [None] * len(commands)
+
+    if unrouted and PIPELINE_MODE == "joint":
+        # the joint template classifies and extracts the unrouted commands in one pass
+        print(f'Generating {len(unrouted)} joint JSON payloads...')
+        router_stats["joint_calls"] += len(unrouted)
+        with stage("joint"):
+            if DECODING_MODE == "constrained":
+                joint_payloads = [constrained_decoder.generate_joint(joint_template.format(instruction=commands[index])) for index in unrouted]
+            else:
+                outputs = generate_batch([joint_template.format(instruction=commands[index]) for index in unrouted])
+                joint_payloads = []
+                for output in outputs:
+                    if_parsed, payload = get_json(output)
+                    if_parsed, payload = parse_joint(payload) if if_parsed else (False, None)
+                    if not if_parsed:
+                        json_failures.labels("joint").inc()
+                    joint_payloads.append(payload)
+        for index, payload in zip(unrouted, joint_payloads):
+            payloads[index] = payload
+            routes.labels("joint", action_label(payload["action"] if payload else None)).inc()
+        unrouted = []
+
+    if unrouted:
+        print(f'Classifying {len(unrouted)} routes...')
+        router_stats["llm_calls"] += len(unrouted)
+        with stage("router"):
+            outputs = generate_batch([router_template.format(instruction=commands[index]) for index in unrouted])
+        for index, output in zip(unrouted, outputs):
+            actions[index] = parse_classification(output)
+            routes.labels("llm", action_label(actions[index])).inc()
+
+    routed = [index for index, action in enumerate(actions) if action in chains]
+
+    print(f'Generating {len(routed)} JSON payloads...')
+    if DECODING_MODE == "constrained":
+        with stage("chain"):
+            for index in routed:
+                start_time = time.perf_counter()
+                payloads[index] = constrained_decoder.generate(actions[index], templates[actions[index]].format(instruction=commands[index]))
+                record_generation(actions[index], json.dumps(payloads[index]["parameters"]), time.perf_counter() - start_time)
+    elif routed:
+        start_time = time.perf_counter()
+        with stage("chain"):
+            outputs = generate_batch([templates[actions[index]].format(instruction=commands[index]) for index in routed])
+        # the sequences of a batch are generated together, each one is counted with the batch duration
+        for index, output in zip(routed, outputs):
+            record_generation(actions[index], output.split("Response:", 1)[-1], time.perf_counter() - start_time)
+        with stage("parse"):
+            for index, output in zip(routed, outputs):
+                if_parsed, payload = get_json(output)
+                payloads[index] = payload if if_parsed else None
+                if not if_parsed:
+                    json_failures.labels(actions[index]).inc()
+
+    return payloads
+
+def split_commands(prompt):
+    # a clause starting with a keyword verb after a separator is a new command,
+    # separators inside a command ("on the left and the right") are kept
+    parts = command_separators.split(prompt.strip())
+    commands = [parts[0]]
+
+    for separator, part in zip(parts[1::2], parts[2::2]):
+        words = part.lower().split()
+        if words and any(words[0].strip(string.punctuation) in keywords for keywords in keyword_categories.values()):
+            commands.append(part)
+        else:
+            commands[-1] += separator + part
+
+    commands = [command.strip().rstrip(",;").strip() for command in commands if command.strip().rstrip(",;")]
+
+    # "it" refers to the object of the previous command
+    for index in range(1, len(commands)):
+        reference = command_object(commands[index - 1])
+        if reference:
+            commands[index] = re.sub(r"\b(it|them)\b", reference, commands[index], flags=re.IGNORECASE)
+
+    return commands
+
+def command_object(command):
+    words = [word.strip(string.punctuation) for word in command.split()[1:]]
+    for word in words:
+        if word and word.lower() not in ("a", "an", "the", "it", "them") and not word.isdigit():
+            return word
+    return None
+
+def classify_keyword(prompt):
+    splitted_prompt = [word.strip(string.punctuation) for word in prompt.lower().split()]
+
+    # count keyword hits per category
+    hits = {}
     for word in splitted_prompt:
-        word_lower = word.lower()
         for category, keywords in keyword_categories.items():
-            if word_lower in keywords:
-                return True, category
-    
-    return False, None 
+            if word in keywords:
+                hits[category] = hits.get(category, 0) + 1
 
-def check_available(object): 
-    try:
-        # Make a GET request to fetch the current prefabs
-        response = requests.get(os.getenv("API_URL") + "response")
-        response.raise_for_status()  # Raise an HTTPError for bad responses (4xx and 5xx)
-        
-        # Parse the response JSON and get the current objects
-        response_json = response.json()  # Ensure the response is in JSON format
-        objects = response_json["response"]["available_prefabs"].split(", ")
+    if not hits:
+        router_stats["no_keyword"] += 1
+        return None, 0.0
 
-        print(objects)
+    # confidence is the share of keyword hits that agree with the best category
+    category = max(hits, key=hits.get)
+    confidence = hits[category] / sum(hits.values())
 
-        return object in objects
-    except Exception as e:
-        print(f"Error in check_prefab: {e}")
-        return False
+    return category, confidence
+
+def check_keyword(prompt):
+    category, confidence = classify_keyword(prompt)
+    return category is not None, category
 
-def check_prefab(object): 
+async def refresh_scene(session_id="default"):
     try:
         # Make a GET request to fetch the current prefabs
-        response = requests.get(os.getenv("API_URL") + "response")
-        print(response)
-
+        response = await http_client.get(os.getenv("API_URL") + "response", params={"session_id": session_id})
         response.raise_for_status()  # Raise an HTTPError for bad responses (4xx and 5xx)
-        
-        # Parse the response JSON and get the current objects
-        response_json = response.json()  # Ensure the response is in JSON format
-        objects = response_json["response"]["current_objects"].split(", ")
 
-        print(objects)
+        scene_index.stats["refreshes"] += 1
+        if response.json()["response"]:
+            scene_index.update(session_id, response.json()["response"])
+    except Exception as e:
+        print(f"Error in refresh_scene: {e}")
 
-        return object in objects
+async def refresh_scene_graph(session_id="default"):
+    try:
+        params = {"session_id": session_id}
+        if scene_index.graph_version(session_id) is not None:
+            params["since_version"] = scene_index.graph_version(session_id)
+        response = await http_client.get(os.getenv("API_URL") + "scene", params=params)
+        response.raise_for_status()
+
+        scene_index.stats["refreshes"] += 1
+        scene = response.json()
+        if not scene["changed"]:
+            scene_index.touch(session_id)
+            return
+        scene_index.set_names(
+            session_id,
+            [scene_object["name"] for scene_object in scene["objects"]],
+            scene["available_prefabs"],
+            graph_version=scene["version"]
+        )
     except Exception as e:
-        print(f"Error in check_prefab: {e}")
-        return False
+        print(f"Error in refresh_scene_graph: {e}")
+
+async def watch_scene(session_id):
+    # keep the scene index in sync with the Unity responses pushed by the API
+    url = os.getenv("API_URL") + "events/response"
+    while True:
+        try:
+            async with http_client.stream("GET", url, params={"session_id": session_id}, timeout=None) as response:
+                scene_index.set_live(session_id, True)
+                async for line in response.aiter_lines():
+                    if line.startswith("data: "):
+                        scene_index.update(session_id, json.loads(line[len("data: "):]))
+        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            print(f"Error in watch_scene: {e}")
+
+        scene_index.set_live(session_id, False)
+        await asyncio.sleep(SCENE_RECONNECT_DELAY)
+
+def stop_watcher(session_id):
+    task, _ = scene_watchers.pop(session_id)
+    task.cancel()
+    scene_index.set_live(session_id, False)
+
+def start_watcher(session_id):
+    now = time.time()
+    for watched_id, (_, last_used) in list(scene_watchers.items()):
+        if watched_id != session_id and now - last_used > SCENE_WATCH_IDLE:
+            stop_watcher(watched_id)
+
+    if session_id in scene_watchers:
+        scene_watchers[session_id] = (scene_watchers[session_id][0], now)
+        scene_watchers.move_to_end(session_id)
+        return
+
+    while len(scene_watchers) >= SCENE_MAX_WATCHERS > 0:
+        stop_watcher(next(iter(scene_watchers)))
+    if SCENE_MAX_WATCHERS <= 0:
+        return
+
+    task = asyncio.create_task(watch_scene(session_id))
+    scene_watchers[session_id] = (task, now)
+
+    def forget(finished):
+        # a watcher that stopped for any reason is started again by the next prompt of its session
+        if not finished.cancelled() and finished.exception() is not None:
+            print(f"Scene watcher of {session_id} failed: {finished.exception()}")
+        if session_id in scene_watchers and scene_watchers[session_id][0] is finished:
+            del scene_watchers[session_id]
+            scene_index.set_live(session_id, False)
+    task.add_done_callback(forget)
+
+async def ensure_scene(session_id="default"):
+    if SCENE_SOURCE == "graph":
+        if not scene_index.is_fresh(session_id):
+            with stage("scene"):
+                await refresh_scene_graph(session_id)
+        return
+
+    if SCENE_WATCH:
+        start_watcher(session_id)
+
+    if not scene_index.is_fresh(session_id):
+        with stage("scene"):
+            await refresh_scene(session_id)
+
+async def check_available(object, session_id="default"): 
+    await ensure_scene(session_id)
+    return scene_index.find_prefab(session_id, object) is not None
+
+async def check_prefab(object, session_id="default", spawned=()): 
+    # objects spawned by an earlier command of the same prompt count as present
+    if normalize_name(object) in {normalize_name(name) for name in spawned}:
+        return True
+
+    await ensure_scene(session_id)
+    return scene_index.find_object(session_id, object) is not None
     
+def prompt_words(prompt):
+    return [word.strip(string.punctuation) for word in prompt.lower().split()]
+
+def find_numbers(splitted_prompt):
+    return [word for word in splitted_prompt if re.fullmatch(r"-?[0-9]+(\.[0-9]+)?", word.strip(string.punctuation))]
+
 def check_direction(splitted_prompt):
-    directions = ["left", "right", "front", "back", "top", "bottom"]
-    return any(word in directions for word in splitted_prompt)
+    return any(word.strip(string.punctuation) in directions for word in splitted_prompt)
 
 def check_axis(splitted_prompt):
-    axes = ['x', 'y', 'z']
-    return any(word in axes for word in splitted_prompt)
+    return any(word.strip(string.punctuation) in axes for word in splitted_prompt)
 
 def check_value(splitted_prompt):
-    pass
+    return len(find_numbers(splitted_prompt)) > 0
+
+def find_mentions(words, session_id, spawned=()):
+    # scene objects and prefabs named in the prompt, longest match first ("engine stand" before "stand")
+    spawned = {normalize_name(name): name for name in spawned}
+    mentions = []
+    index = 0
+    while index < len(words):
+        for length in (3, 2, 1):
+            name = "_".join(words[index:index + length])
+            if len(words[index:index + length]) < length or not name:
+                continue
+            scene_object, prefab = scene_index.lookup(session_id, name)
+            scene_object = scene_object or spawned.get(normalize_name(name))
+            if scene_object is not None or prefab is not None:
+                mentions.append((scene_object, prefab))
+                index += length
+                break
+        else:
+            index += 1
+    return mentions
+
+def rule_numbers(prompt):
+    # numbers as written in the prompt, None when any token with a digit is not plain ASCII digits
+    # (signed, decimal, "3rd", "2x", other scripts) so the chain handles it
+    tokens = [token.rstrip(".,!?;:") for token in prompt.split()]
+    numbers = [token for token in tokens if any(char.isdigit() for char in token)]
+    if any(not re.fullmatch(r"[0-9]+", number) for number in numbers):
+        return None
+    return numbers
+
+def single(words, vocabulary):
+    found = [word for word in words if word in vocabulary]
+    return found[0] if len(set(found)) == 1 else None
+
+def extract_slots(prompt, category, confidence, session_id="default", spawned=()):
+    # deterministic payload for prompts with one verb, known names and unambiguous slots, otherwise None
+    if not SLOT_EXTRACTOR or category is None or confidence < 1.0:
+        return None
+
+    words = prompt_words(prompt)
+    if any(word in rule_stop_words for word in words):
+        return None
+
+    # slot words are never part of a name
+    name_words = [word for word in words if word not in directions and word not in axes and word != "reset" and not find_numbers([word])]
+    mentions = find_mentions(name_words, session_id, spawned)
+    numbers = rule_numbers(prompt)
+    if numbers is None or len(numbers) > 1:
+        return None
+    value = numbers[0] if numbers else None
+
+    if category == "spawn":
+        if len(mentions) != 2 or mentions[0][1] is None or mentions[1][0] is None:
+            return None
+        direction = single(words, directions)
+        if direction is None:
+            return None
+        parameters = {"prefab": mentions[0][1], "reference_object": mentions[1][0], "direction": direction, "value": value or "1"}
+
+    elif category == "move":
+        if len(mentions) != 1 or mentions[0][0] is None:
+            return None
+        direction = single(words, directions)
+        if direction is None:
+            return None
+        parameters = {"prefab": mentions[0][0], "direction": direction, "value": value or "1"}
+
+    elif category == "rotate":
+        if len(mentions) != 1 or mentions[0][0] is None:
+            return None
+        if "reset" in words:
+            parameters = {"prefab": mentions[0][0], "axis": "reset", "value": value or "0"}
+        else:
+            axis = single(words, axes)
+            if axis is None or value is None:
+                return None
+            parameters = {"prefab": mentions[0][0], "axis": axis, "value": value}
+
+    elif category == "replace":
+        if len(mentions) != 2 or mentions[0][0] is None or mentions[1][1] is None:
+            return None
+        parameters = {"prefab": mentions[1][1], "object_to_replace": mentions[0][0]}
+
+    elif category == "remove":
+        if len(mentions) != 1 or mentions[0][0] is None:
+            return None
+        parameters = {"prefab": mentions[0][0]}
+
+    else:
+        return None
+
+    return {"action": category, "parameters": parameters}
+
+def rule_invoke(prompt, category, confidence, session_id="default", on_event=None):
+    with stage("rules"):
+        payload = extract_slots(prompt, category, confidence, session_id)
+    if payload is None:
+        if SLOT_EXTRACTOR and category is not None:
+            router_stats["rule_fallbacks"] += 1
+        return None
+
+    router_stats["rule_hits"] += 1
+    routes.labels("rules", category).inc()
+    print(f"Payload extracted by rules: {json.dumps(payload)}")
+    if on_event is not None:
+        on_event("classification", {"action": category, "source": "rules", "confidence": confidence})
+        on_event("payload", {"parsed": True, "payload": payload, "source": "rules"})
+    return payload
 
 # endpoint
 class UserPrompt(BaseModel):
     prompt: str
+    session_id: str = "default"
 
-def generate_response(status, result, prompt): 
+async def generate_response(status, result, prompt, category=None, confidence=0.0, session_id="default"): 
     if(status): 
-        result = full_invoke(prompt)
-            
-        time.sleep(5)
+        payload = await invoke(prompt, category, confidence, session_id)
+        if payload is None:
+            return failure_response("Could not generate the instruction. Please rephrase it.")
 
-        response = requests.get(os.getenv("API_URL") + "response")
-        return response.content
+        instruction_id = await dispatch(payload, session_id)
+        return await wait_for_unity(instruction_id, session_id)
     else:
         return result
 
@@ -354,10 +1149,9 @@ def format_missing_items(items):
         return items[0]
     return ', '.join(items[:-1]) + f", and {items[-1]}"
 
-@app.post("/set/prompt")
-async def set_response(response_obj: UserPrompt):
-    prompt = response_obj.prompt
-    category_status, category = check_keyword(prompt)
+async def validate_prompt(prompt, category, session_id="default", spawned=()):
+    # returns the message for the user when the prompt is missing something, otherwise None
+    category_status = category is not None
 
     data = {"response": {"message": ""}}
     missing_items = []
@@ -371,8 +1165,8 @@ async def set_response(response_obj: UserPrompt):
 
         # Define checks for each category
         if category == "spawn":
-            prefab_status = check_available(splitted_prompt[1])
-            reference_prefab_status = check_prefab(splitted_prompt[-1])
+            prefab_status = await check_available(splitted_prompt[1], session_id)
+            reference_prefab_status = await check_prefab(splitted_prompt[-1], session_id, spawned)
             direction_status = check_direction(splitted_prompt)
 
             if not prefab_status:
@@ -384,12 +1178,12 @@ async def set_response(response_obj: UserPrompt):
 
             if missing_items:
                 format_response("Spawn", missing_items)
-                return generate_response(False, data, prompt)
+                return data
             else:
-                return generate_response(True, {"message": "Spawn action successful."}, prompt)
+                return None
 
         elif category == "move":
-            prefab = check_prefab(splitted_prompt[1])
+            prefab = await check_prefab(splitted_prompt[1], session_id, spawned)
             direction_status = check_direction(splitted_prompt)
 
             if not prefab:
@@ -399,13 +1193,13 @@ async def set_response(response_obj: UserPrompt):
 
             if missing_items:
                 format_response("Move", missing_items)
-                return generate_response(False, data, prompt)
+                return data
             else:
-                return generate_response(True, {"message": "Move action successful."}, prompt)
+                return None
 
         elif category == "replace":
-            replace_prefab = check_prefab(splitted_prompt[1])
-            prefab = check_available(splitted_prompt[-1])
+            replace_prefab = await check_prefab(splitted_prompt[1], session_id, spawned)
+            prefab = await check_available(splitted_prompt[-1], session_id)
 
             if not prefab:
                 missing_items.append("new prefab")
@@ -414,12 +1208,12 @@ async def set_response(response_obj: UserPrompt):
 
             if missing_items:
                 format_response("Replace", missing_items)
-                return generate_response(False, data, prompt)
+                return data
             else:
-                return generate_response(True, {"message": "Replace action successful."}, prompt)
+                return None
 
         elif category == "rotate":
-            prefab = check_prefab(splitted_prompt[1])
+            prefab = await check_prefab(splitted_prompt[1], session_id, spawned)
             check_axis_status = check_axis(splitted_prompt)
 
             if not prefab:
@@ -429,22 +1223,241 @@ async def set_response(response_obj: UserPrompt):
 
             if missing_items:
                 format_response("Rotate", missing_items)
-                return generate_response(False, data, prompt)
+                return data
             else:
-                return generate_response(True, {"message": "Rotate action successful."}, prompt)
+                return None
 
         elif category == "remove":
-            prefab = check_prefab(splitted_prompt[1])
+            prefab = await check_prefab(splitted_prompt[1], session_id, spawned)
 
             if not prefab:
                 missing_items.append("new prefab")
 
             if missing_items:
                 format_response("Remove", missing_items)
-                return generate_response(False, data, prompt)
+                return data
             else:
-                return generate_response(True, {"message": "Remove action successful."}, prompt)
+                return None
 
     else:
         data["response"]["message"] = "Invalid action. Please specify a valid action."
-        return generate_response(False, data, prompt)
+        return data
+
+async def compound_response(commands, session_id="default", on_event=None):
+    with stage("keyword"):
+        categories, confidences = zip(*[classify_keyword(command) for command in commands])
+
+    # validate every command, objects spawned by earlier commands are not in the scene yet
+    spawned = []
+    messages = []
+    for index, (command, category) in enumerate(zip(commands, categories)):
+        data = await validate_prompt(command, category, session_id, spawned)
+        if data is not None:
+            messages.append(f"Command {index + 1}: {data['response']['message']}")
+        elif category == "spawn" and command_object(command):
+            spawned.append(command_object(command))
+
+    if messages:
+        return {"response": {"message": " ".join(messages)}}
+
+    # simple sub-commands are parsed directly, only the rest go through the model
+    payloads = []
+    spawned = []
+    for command, category, confidence in zip(commands, categories, confidences):
+        with stage("rules"):
+            payload = extract_slots(command, category, confidence, session_id, spawned)
+        if SLOT_EXTRACTOR and category is not None:
+            router_stats["rule_hits" if payload is not None else "rule_fallbacks"] += 1
+        payloads.append(payload)
+        if category == "spawn" and command_object(command):
+            spawned.append(command_object(command))
+
+    remaining = [index for index, payload in enumerate(payloads) if payload is None]
+    if remaining:
+        loop = asyncio.get_running_loop()
+        generated = await loop.run_in_executor(inference_pool, in_context(
+            route_batch,
+            [commands[index] for index in remaining],
+            [categories[index] for index in remaining],
+            [confidences[index] for index in remaining]
+        ))
+        for index, payload in zip(remaining, generated):
+            payloads[index] = payload
+
+    if on_event is not None:
+        for index, (command, payload) in enumerate(zip(commands, payloads)):
+            on_event("payload", {"index": index, "command": command, "parsed": payload is not None, "payload": payload})
+
+    failed = [str(index + 1) for index, payload in enumerate(payloads) if payload is None]
+    if failed:
+        return {"response": {"message": f"Could not generate command {', '.join(failed)}. Please rephrase it."}}
+
+    # every sub-command is queued in one transaction
+    with stage("dispatch"):
+        response = await http_client.post(
+            os.getenv("API_URL") + "set/batch",
+            json={"instructions": payloads},
+            params={"session_id": session_id}
+        )
+    print(f"Batch Response Code: {response.status_code}\nPayload:{payloads}")
+
+    instruction_id = None
+    if response.status_code == 200 and response.json().get("success"):
+        # Unity applies the batch in order, its last acknowledgement covers the whole prompt
+        instruction_id = response.json()["payload"][-1]["id"]
+        record_dispatch(instruction_id)
+    if on_event is not None:
+        instruction_ids = [instruction["id"] for instruction in response.json()["payload"]] if instruction_id is not None else []
+        on_event("dispatch", {"success": instruction_id is not None, "instruction_ids": instruction_ids})
+    return await wait_for_unity(instruction_id, session_id)
+
+@app.post("/set/prompt")
+async def set_response(response_obj: UserPrompt, response: Response):
+    # the duration of every stage is reported in the Server-Timing header
+    stages = start_request()
+    try:
+        with request_seconds.labels("/set/prompt").time():
+            return await handle_prompt(response_obj.prompt, response_obj.session_id)
+    finally:
+        response.headers["Server-Timing"] = server_timing(stages)
+
+async def handle_prompt(prompt, session_id="default"):
+    commands = split_commands(prompt)
+    if len(commands) > 1:
+        print(f"Compound prompt: {commands}")
+        return await compound_response(commands, session_id)
+
+    with stage("keyword"):
+        category, confidence = classify_keyword(prompt)
+
+    data = await validate_prompt(prompt, category, session_id)
+    if data is not None:
+        return await generate_response(False, data, prompt)
+
+    return await generate_response(True, {"message": f"{category.capitalize()} action successful."}, prompt, category, confidence, session_id)
+
+@app.post("/set/prompt/stream")
+async def set_response_stream(response_obj: UserPrompt):
+    # same flow as /set/prompt, reported as server-sent events while it runs:
+    # message, classification, token, payload, dispatch, ack, error and done,
+    # a compound prompt reports one payload event per command and one dispatch event for the batch
+    prompt = response_obj.prompt
+    session_id = response_obj.session_id
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def emit(event, data):
+        # called from the inference pool as well as the event loop
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    def emit_ack(raw_response):
+        response = json.loads(raw_response)
+        if response["response"].get("success") is False:
+            emit("error", {"error": response["response"]["message"]})
+        else:
+            emit("ack", response)
+
+    async def run():
+        stages = start_request()
+        start_time = time.perf_counter()
+        try:
+            # compound prompts are queued as one batch, every command gets its payload event
+            commands = split_commands(prompt)
+            if len(commands) > 1:
+                print(f"Compound prompt: {commands}")
+                result = await compound_response(commands, session_id, emit)
+                if isinstance(result, dict):
+                    emit("message", result)
+                else:
+                    emit_ack(result)
+                return
+
+            with stage("keyword"):
+                category, confidence = classify_keyword(prompt)
+            data = await validate_prompt(prompt, category, session_id)
+            if data is not None:
+                emit("message", data)
+                return
+
+            payload = await invoke(prompt, category, confidence, session_id, emit)
+            if payload is None:
+                emit("message", {"response": {"message": "Could not generate the instruction. Please rephrase it."}})
+                return
+
+            instruction_id = await dispatch(payload, session_id)
+            emit("dispatch", {"success": instruction_id is not None, "instruction_id": instruction_id})
+
+            emit_ack(await wait_for_unity(instruction_id, session_id))
+        except Exception as e:
+            print(f"Error in set_response_stream: {e}")
+            emit("error", {"error": str(e)})
+        finally:
+            request_seconds.labels("/set/prompt/stream").observe(time.perf_counter() - start_time)
+            emit("done", {"timings": {name: seconds * 1000 for name, seconds in stages.items()}})
+
+    async def event_stream():
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                event, data = await events.get()
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                if event == "done":
+                    break
+        finally:
+            await task
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.on_event("shutdown")
+async def shutdown():
+    for watcher, _ in scene_watchers.values():
+        watcher.cancel()
+    await http_client.aclose()
+    inference_pool.shutdown(wait=False)
+
+@app.get("/router/stats")
+async def get_router_stats():
+    total = router_stats["keyword_hits"] + router_stats["keyword_misses"]
+    return {
+        "mode": ROUTER_MODE,
+        "pipeline": PIPELINE_MODE,
+        "confidence_threshold": KEYWORD_CONFIDENCE,
+        "hit_rate": router_stats["keyword_hits"] / total if total else 0.0,
+        **router_stats
+    }
+
+@app.get("/prefix_cache/stats")
+async def get_prefix_cache_stats():
+    if prefix_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, "templates": len(prefix_cache.entries), **prefix_cache.stats}
+
+@app.get("/speculative/stats")
+async def get_speculative_stats():
+    if speculative_decoder is None:
+        return {"enabled": False}
+    return {"enabled": True, **speculative_decoder.report()}
+
+@app.get("/batching/stats")
+async def get_batching_stats():
+    if batch_scheduler is None:
+        return {"enabled": False}
+    return {"enabled": True, **batch_scheduler.report()}
+
+@app.get("/scene/stats")
+async def get_scene_stats():
+    return {"watchers": len(scene_watchers), "max_watchers": SCENE_MAX_WATCHERS, **scene_index.report()}
+
+@app.get("/response_cache/stats")
+async def get_response_cache_stats():
+    if response_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **response_cache.report()}
+
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response()
+
+@app.get("/startup")
+async def get_startup():
+    return startup_report
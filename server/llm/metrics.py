@@ -0,0 +1,31 @@
+import os
+
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer("aerovrtuoso.llm")
+except ImportError:
+    tracer = None
+
+# generation takes seconds, the other stages milliseconds
+latency_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+request_seconds = Histogram("llm_request_seconds", "Prompt handling time per endpoint", ["endpoint"], buckets=latency_buckets)
+stage_seconds = Histogram("llm_stage_seconds", "Time spent in each stage of a prompt", ["stage"], buckets=latency_buckets)
+chain_seconds = Histogram("llm_chain_seconds", "Chain invoke time per action", ["action"], buckets=latency_buckets)
+generated_tokens = Counter("llm_generated_tokens_total", "Tokens generated per action", ["action"])
+tokens_per_second = Histogram("llm_tokens_per_second", "Generation speed per action", ["action"], buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+json_failures = Counter("llm_json_parse_failures_total", "Chain outputs get_json could not parse", ["action"])
+routes = Counter("llm_routes_total", "Prompts per routing source and action", ["source", "action"])
+
+
+def metrics_response():
+    # gunicorn workers write their samples to PROMETHEUS_MULTIPROC_DIR, the scrape merges them
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,87 @@
+import time
+from contextlib import contextmanager
+
+import torch
+from peft import PeftModel
+from transformers import AutoModelForCausalLM
+
+# fp32 - full precision
+# bf16 - bfloat16 weights, half the memory
+# int8 - dynamic int8 quantization of the linear layers
+precisions = ["fp32", "bf16", "int8"]
+
+
+def quantize(model, precision):
+    if precision == "bf16":
+        return model.to(torch.bfloat16)
+    if precision == "int8":
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+# records how long each startup phase takes
+class PhaseTimer:
+    def __init__(self):
+        self.started_at = time.time()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start_time = time.time()
+        yield
+        self.phases[name] = time.time() - start_time
+        print(f"{name} took {self.phases[name]:.2f}s")
+
+    def report(self):
+        return {
+            "phases": dict(self.phases),
+            "total": time.time() - self.started_at
+        }
+
+
+def load_model(base_model_name, peft_model_name, precision="fp32", merge=True):
+    if precision not in precisions:
+        raise ValueError(f"Precision is invalid. {precisions}")
+
+    # the adapter is applied in full precision, the result is converted afterwards
+    print("Loading base model...")
+    model = AutoModelForCausalLM.from_pretrained(base_model_name, torch_dtype=torch.float32)
+    print("Base model loaded.")
+
+    print("Loading PEFT model...")
+    model = PeftModel.from_pretrained(model, peft_model_name)
+    print("PEFT model loaded.")
+
+    if merge:
+        # fold the LoRA deltas into q_proj/v_proj so inference runs on a plain model
+        print("Merging LoRA weights...")
+        model = model.merge_and_unload()
+
+    model.eval()
+
+    if precision != "fp32":
+        print(f"Converting model to {precision}...")
+    return quantize(model, precision)
+
+
+def load_exported(model_path, precision="fp32"):
+    if precision not in precisions:
+        raise ValueError(f"Precision is invalid. {precisions}")
+
+    # safetensors snapshots are memory-mapped, workers loading the same file share its pages
+    print(f"Loading exported model from {model_path}...")
+    model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype="auto", low_cpu_mem_usage=True)
+    print("Exported model loaded.")
+
+    model.eval()
+
+    # export in the served precision so the mapped weights are used as they are
+    if precision == "bf16" and model.dtype == torch.bfloat16:
+        return model
+    if model.dtype != torch.float32:
+        model = model.to(torch.float32)
+
+    # dynamic quantization is not serializable, it is applied at load time on fp32 weights
+    if precision != "fp32":
+        print(f"Converting model to {precision}...")
+    return quantize(model, precision)
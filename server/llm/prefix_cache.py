@@ -0,0 +1,90 @@
+import copy
+import torch
+from transformers import DynamicCache
+
+# placeholder used to cut the static part out of a template
+INSTRUCTION_MARKER = "<<instruction>>"
+
+
+# keeps the past-key-values of the static part of each prompt template
+# (instruction block and few-shot example) so a request only prefills its own sentence
+class PrefixCache:
+    def __init__(self, model, tokenizer, generation_config):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.generation_config = generation_config
+        self.entries = []
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "cached_tokens": 0,
+            "prefilled_tokens": 0
+        }
+
+    def add(self, template):
+        prefix_text = template.format(instruction=INSTRUCTION_MARKER).split(INSTRUCTION_MARKER)[0]
+        prefix_ids = self.tokenizer.encode(prefix_text)
+
+        past_key_values = DynamicCache()
+        with torch.no_grad():
+            self.model(
+                input_ids=torch.tensor([prefix_ids], device=self.model.device),
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+
+        self.entries.append((prefix_text, prefix_ids, past_key_values))
+        print(f"Cached prefix: {len(prefix_ids)} tokens")
+
+    def warm(self, prompt_templates):
+        for template in prompt_templates:
+            self.add(template)
+
+    def lookup(self, prompt_text):
+        # returns the prompt ids, a private copy of the matching cache and how many ids it covers
+        input_ids = self.tokenizer.encode(prompt_text)
+
+        for prefix_text, prefix_ids, past_key_values in self.entries:
+            if not prompt_text.startswith(prefix_text):
+                continue
+
+            # the tokenizer may merge tokens across the boundary, only reuse the ids that agree
+            cached_length = 0
+            for prompt_id, prefix_id in zip(input_ids, prefix_ids):
+                if prompt_id != prefix_id:
+                    break
+                cached_length += 1
+
+            # generation needs at least one uncached token
+            cached_length = min(cached_length, len(input_ids) - 1)
+            if cached_length == 0:
+                break
+
+            past_key_values = copy.deepcopy(past_key_values)
+            if cached_length < len(prefix_ids):
+                past_key_values.crop(cached_length)
+
+            self.stats["hits"] += 1
+            self.stats["cached_tokens"] += cached_length
+            self.stats["prefilled_tokens"] += len(input_ids) - cached_length
+            return input_ids, past_key_values, cached_length
+
+        self.stats["misses"] += 1
+        self.stats["prefilled_tokens"] += len(input_ids)
+        return input_ids, None, 0
+
+    def generate(self, prompt_text, streamer=None):
+        input_ids, past_key_values, cached_length = self.lookup(prompt_text)
+
+        input_tensor = torch.tensor([input_ids], device=self.model.device)
+        with torch.no_grad():
+            output = self.model.generate(
+                input_ids=input_tensor,
+                attention_mask=torch.ones_like(input_tensor),
+                past_key_values=past_key_values,
+                generation_config=self.generation_config,
+                streamer=streamer
+            )
+
+        # return the prompt together with the completion like the pipeline does
+        return prompt_text + self.tokenizer.decode(output[0][len(input_ids):], skip_special_tokens=True)
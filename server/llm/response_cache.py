@@ -0,0 +1,197 @@
+import hashlib
+import json
+import re
+import string
+import threading
+import time
+from collections import OrderedDict
+
+from scene_index import normalize_name
+
+try:
+    from redis import Redis
+except ImportError:
+    Redis = None
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+# words that change the payload even when two prompts are otherwise similar
+slot_words = {"left", "right", "front", "back", "top", "bottom", "x", "y", "z", "reset"}
+
+
+def normalize_prompt(prompt):
+    words = [word.strip(string.punctuation) for word in prompt.lower().split()]
+    return " ".join(word for word in words if word)
+
+
+# longest scene name, in words, looked for in a prompt
+MAX_NAME_WORDS = 3
+
+
+def slot_signature(normalized_prompt, vocabulary=()):
+    # numbers, directions, axes and the scene objects and prefabs named in the prompt
+    # have to match exactly for a similar prompt to be reused
+    words = normalized_prompt.split()
+    slots = tuple(word for word in words if word in slot_words or re.fullmatch(r"\d+", word))
+
+    names = {entry.split(":", 1)[-1] for entry in vocabulary}
+    mentioned = {
+        normalize_name(" ".join(words[start:start + size]))
+        for size in range(1, MAX_NAME_WORDS + 1)
+        for start in range(len(words) - size + 1)
+    }
+    return slots + tuple(sorted(names & mentioned))
+
+
+# prompt -> payload cache in front of route:
+# an exact tier keyed on the normalized prompt and the scene vocabulary (local LRU, optionally shared
+# through Redis) and an optional embedding tier for near-duplicate prompts
+class ResponseCache:
+    def __init__(self, max_entries=1024, ttl=3600, redis_url=None, embedding_model=None, similarity=0.92):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            "exact_hits": 0,
+            "redis_hits": 0,
+            "semantic_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "saved_seconds": 0.0
+        }
+
+        self.redis = None
+        if redis_url:
+            if Redis is None:
+                print("redis is not installed, the response cache stays local")
+            else:
+                self.redis = Redis.from_url(redis_url)
+
+        self.embedder = None
+        self.embeddings = OrderedDict()
+        if embedding_model:
+            if SentenceTransformer is None:
+                print("sentence-transformers is not installed, semantic cache disabled")
+            else:
+                self.embedder = SentenceTransformer(embedding_model)
+
+    def _key(self, normalized_prompt, vocabulary):
+        vocabulary_hash = hashlib.sha1("\n".join(sorted(vocabulary)).encode()).hexdigest()
+        return hashlib.sha1(f"{vocabulary_hash}:{normalized_prompt}".encode()).hexdigest(), vocabulary_hash
+
+    def _embed(self, normalized_prompt):
+        return self.embedder.encode(normalized_prompt, normalize_embeddings=True)
+
+    def _hit(self, tier, entry):
+        with self.lock:
+            self.stats[tier] += 1
+            self.stats["saved_seconds"] += entry["generation_time"]
+        return entry["payload"]
+
+    def get(self, prompt, vocabulary=()):
+        normalized_prompt = normalize_prompt(prompt)
+        key, vocabulary_hash = self._key(normalized_prompt, vocabulary)
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["expires_at"] < now:
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is not None:
+            return self._hit("exact_hits", entry)
+
+        # shared with the other LLM workers
+        if self.redis is not None:
+            try:
+                cached = self.redis.get(f"llm_cache:{key}")
+            except Exception as e:
+                print(f"Error reading response cache: {e}")
+                cached = None
+            if cached is not None:
+                entry = json.loads(cached)
+                self._store_local(key, entry)
+                return self._hit("redis_hits", entry)
+
+        if self.embedder is not None:
+            entry = self._nearest(normalized_prompt, vocabulary, vocabulary_hash, now)
+            if entry is not None:
+                return self._hit("semantic_hits", entry)
+
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def _nearest(self, normalized_prompt, vocabulary, vocabulary_hash, now):
+        vector = self._embed(normalized_prompt)
+        signature = slot_signature(normalized_prompt, vocabulary)
+
+        best_entry, best_score = None, self.similarity
+        with self.lock:
+            candidates = list(self.embeddings.values())
+        for entry in candidates:
+            if entry["vocabulary"] != vocabulary_hash or entry["signature"] != signature or entry["expires_at"] < now:
+                continue
+            score = float(vector @ entry["vector"])
+            if score >= best_score:
+                best_entry, best_score = entry, score
+
+        return best_entry
+
+    def _store_local(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def put(self, prompt, payload, generation_time, vocabulary=()):
+        normalized_prompt = normalize_prompt(prompt)
+        key, vocabulary_hash = self._key(normalized_prompt, vocabulary)
+        entry = {
+            "payload": payload,
+            "generation_time": generation_time,
+            "expires_at": time.time() + self.ttl
+        }
+
+        self._store_local(key, entry)
+        with self.lock:
+            self.stats["stores"] += 1
+
+        if self.redis is not None:
+            try:
+                self.redis.setex(f"llm_cache:{key}", self.ttl, json.dumps(entry))
+            except Exception as e:
+                print(f"Error writing response cache: {e}")
+
+        if self.embedder is not None:
+            semantic_entry = {
+                **entry,
+                "vector": self._embed(normalized_prompt),
+                "vocabulary": vocabulary_hash,
+                "signature": slot_signature(normalized_prompt, vocabulary)
+            }
+            with self.lock:
+                self.embeddings[key] = semantic_entry
+                while len(self.embeddings) > self.max_entries:
+                    self.embeddings.popitem(last=False)
+
+    def report(self):
+        with self.lock:
+            hits = self.stats["exact_hits"] + self.stats["redis_hits"] + self.stats["semantic_hits"]
+            lookups = hits + self.stats["misses"]
+            return {
+                "entries": len(self.entries),
+                "redis": self.redis is not None,
+                "semantic": self.embedder is not None,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                **self.stats
+            }
@@ -0,0 +1,117 @@
+import time
+
+articles = {"a", "an", "the"}
+
+
+def normalize_name(name):
+    # case, spaces, hyphens and articles do not matter, plurals match their singular
+    words = [word for word in name.lower().replace("-", " ").replace("_", " ").split() if word not in articles]
+    if not words:
+        return ""
+
+    last = words[-1]
+    if last.endswith("ies") and len(last) > 4:
+        last = last[:-3] + "y"
+    elif last.endswith(("ches", "shes", "xes", "sses")):
+        last = last[:-2]
+    elif last.endswith("s") and not last.endswith("ss") and len(last) > 3:
+        last = last[:-1]
+    words[-1] = last
+
+    return "_".join(words)
+
+
+def split_names(names):
+    return [name.strip() for name in (names or "").split(",") if name.strip()]
+
+
+# local index of the scene objects and available prefabs of every session,
+# kept fresh by the pushed Unity responses or refreshed once it is older than ttl
+class SceneIndex:
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self.sessions = {}
+        self.stats = {
+            "lookups": 0,
+            "hits": 0,
+            "misses": 0,
+            "updates": 0,
+            "refreshes": 0
+        }
+
+    def _session(self, session_id):
+        if session_id not in self.sessions:
+            self.sessions[session_id] = {
+                "objects": {},
+                "prefabs": {},
+                "version": 0,
+                "graph_version": None,
+                "updated_at": 0.0,
+                "live": False
+            }
+        return self.sessions[session_id]
+
+    def update(self, session_id, response):
+        self.set_names(session_id, split_names(response.get("current_objects")), split_names(response.get("available_prefabs")))
+
+    def set_names(self, session_id, objects, prefabs, graph_version=None):
+        session = self._session(session_id)
+        session["objects"] = {normalize_name(name): name for name in objects}
+        session["prefabs"] = {normalize_name(name): name for name in prefabs}
+        session["version"] += 1
+        session["graph_version"] = graph_version
+        session["updated_at"] = time.time()
+        self.stats["updates"] += 1
+
+    def graph_version(self, session_id):
+        return self._session(session_id)["graph_version"]
+
+    def touch(self, session_id):
+        # the scene graph did not change since the last refresh
+        self._session(session_id)["updated_at"] = time.time()
+
+    def set_live(self, session_id, live):
+        self._session(session_id)["live"] = live
+
+    def is_fresh(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None or session["version"] == 0:
+            return False
+        return session["live"] or time.time() - session["updated_at"] < self.ttl
+
+    def _find(self, session_id, kind, name):
+        self.stats["lookups"] += 1
+        match = self._session(session_id)[kind].get(normalize_name(name))
+        self.stats["hits" if match is not None else "misses"] += 1
+        return match
+
+    def find_object(self, session_id, name):
+        return self._find(session_id, "objects", name)
+
+    def find_prefab(self, session_id, name):
+        return self._find(session_id, "prefabs", name)
+
+    def lookup(self, session_id, name):
+        # scene object and prefab matching the name, without counting it as a validation lookup
+        session = self._session(session_id)
+        key = normalize_name(name)
+        return session["objects"].get(key), session["prefabs"].get(key)
+
+    def vocabulary(self, session_id):
+        session = self._session(session_id)
+        return [f"object:{name}" for name in session["objects"]] + [f"prefab:{name}" for name in session["prefabs"]]
+
+    def report(self):
+        return {
+            "ttl": self.ttl,
+            "sessions": {
+                session_id: {
+                    "objects": len(session["objects"]),
+                    "prefabs": len(session["prefabs"]),
+                    "version": session["version"],
+                    "live": session["live"]
+                }
+                for session_id, session in self.sessions.items()
+            },
+            **self.stats
+        }
@@ -0,0 +1,152 @@
+import torch
+from transformers import DynamicCache
+
+
+# greedy decoding that drafts several tokens at a time and verifies them in one forward pass
+# drafts come from the prompt itself (the chains mostly copy names, directions and numbers from the
+# sentence) or from a smaller draft model sharing the tokenizer, the output is the same as plain greedy decoding,
+# a generation config that samples is decoded greedily too, so enabling it also changes the decoding strategy
+class SpeculativeDecoder:
+    def __init__(self, model, tokenizer, generation_config, num_draft_tokens=8, ngram_size=3, draft_model=None, prefix_cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.draft_model = draft_model
+        self.prefix_cache = prefix_cache
+        self.num_draft_tokens = num_draft_tokens
+        self.ngram_size = ngram_size
+        self.max_new_tokens = generation_config.max_new_tokens
+        self.repetition_penalty = generation_config.repetition_penalty or 1.0
+        self.replaces_sampling = bool(generation_config.do_sample)
+        self.eos_token_id = tokenizer.eos_token_id
+        self.stats = {
+            "calls": 0,
+            "generated_tokens": 0,
+            "drafted_tokens": 0,
+            "accepted_tokens": 0,
+            "forward_passes": 0
+        }
+
+    def _penalize(self, logits, sequence):
+        # same as the repetition penalty of generate, applied to every verified position
+        if self.repetition_penalty == 1.0:
+            return logits
+        ids = torch.tensor(sorted(set(sequence)), device=logits.device)
+        scores = logits[ids]
+        logits = logits.clone()
+        logits[ids] = torch.where(scores < 0, scores * self.repetition_penalty, scores / self.repetition_penalty)
+        return logits
+
+    def _lookup_draft(self, sequence):
+        # continue the latest earlier occurrence of the trailing n-gram, longest n-gram first
+        for size in range(self.ngram_size, 0, -1):
+            if len(sequence) <= size:
+                continue
+            ngram = sequence[-size:]
+            for start in range(len(sequence) - size - 1, -1, -1):
+                if sequence[start:start + size] == ngram:
+                    draft = sequence[start + size:start + size + self.num_draft_tokens]
+                    if draft:
+                        return draft
+        return []
+
+    def _model_draft(self, sequence, state):
+        # the draft model keeps its own cache, covering state["length"] tokens of the sequence
+        pending = sequence[state["length"]:]
+        draft = []
+        with torch.no_grad():
+            for _ in range(self.num_draft_tokens):
+                output = self.draft_model(
+                    input_ids=torch.tensor([pending], device=self.draft_model.device),
+                    past_key_values=state["past_key_values"],
+                    use_cache=True
+                )
+                token_id = int(torch.argmax(output.logits[0, -1]))
+                draft.append(token_id)
+                if token_id == self.eos_token_id:
+                    break
+                pending = [token_id]
+
+        # the last draft token has not been fed to the draft model
+        state["length"] = len(sequence) + len(draft) - 1
+        return draft
+
+    def generate(self, prompt_text, streamer=None):
+        if self.prefix_cache is not None:
+            input_ids, past_key_values, cached_length = self.prefix_cache.lookup(prompt_text)
+        else:
+            input_ids, past_key_values, cached_length = self.tokenizer.encode(prompt_text), None, 0
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+
+        draft_state = {"past_key_values": DynamicCache(), "length": 0}
+        sequence = list(input_ids)
+        pending = sequence[cached_length:]
+        generated = []
+        self.stats["calls"] += 1
+
+        if streamer is not None:
+            streamer.put(torch.tensor(input_ids))
+
+        while len(generated) < self.max_new_tokens:
+            remaining = self.max_new_tokens - len(generated)
+            draft = self._model_draft(sequence, draft_state) if self.draft_model is not None else self._lookup_draft(sequence)
+            draft = draft[:remaining - 1]
+
+            with torch.no_grad():
+                output = self.model(
+                    input_ids=torch.tensor([pending + draft], device=self.model.device),
+                    past_key_values=past_key_values,
+                    use_cache=True
+                )
+            self.stats["forward_passes"] += 1
+            logits = output.logits[0, len(pending) - 1:].float()
+
+            # keep the drafted tokens the model agrees with, plus the model's own next token
+            accepted = []
+            for index in range(len(draft) + 1):
+                token_id = int(torch.argmax(self._penalize(logits[index], sequence + accepted)))
+                accepted.append(token_id)
+                if index == len(draft) or token_id != draft[index]:
+                    break
+
+            self.stats["drafted_tokens"] += len(draft)
+            self.stats["accepted_tokens"] += len(accepted) - 1
+
+            finished = self.eos_token_id in accepted
+            if finished:
+                accepted = accepted[:accepted.index(self.eos_token_id)]
+
+            # drop the rejected drafts from both caches, the last accepted token is fed next
+            past_key_values.crop(len(sequence) + len(accepted) - 1 if accepted else len(sequence))
+            if self.draft_model is not None and draft_state["length"] > len(sequence) + len(accepted) - 1:
+                draft_state["past_key_values"].crop(len(sequence) + max(len(accepted) - 1, 0))
+                draft_state["length"] = len(sequence) + max(len(accepted) - 1, 0)
+
+            sequence += accepted
+            generated += accepted
+            pending = accepted[-1:]
+            if streamer is not None and accepted:
+                streamer.put(torch.tensor(accepted))
+            if finished or not accepted:
+                break
+
+        if streamer is not None:
+            streamer.end()
+
+        self.stats["generated_tokens"] += len(generated)
+
+        # return the prompt together with the completion like the pipeline does
+        return prompt_text + self.tokenizer.decode(generated, skip_special_tokens=True)
+
+    def report(self):
+        drafted = self.stats["drafted_tokens"]
+        forward_passes = self.stats["forward_passes"]
+        return {
+            "mode": "draft_model" if self.draft_model is not None else "prompt_lookup",
+            # compare against greedy decoding without speculation, not against the sampling pipeline
+            "decoding": "greedy",
+            "replaces_sampling": self.replaces_sampling,
+            "acceptance_rate": self.stats["accepted_tokens"] / drafted if drafted else 0.0,
+            "tokens_per_forward": self.stats["generated_tokens"] / forward_passes if forward_passes else 0.0,
+            **self.stats
+        }
@@ -0,0 +1,50 @@
+import contextvars
+import functools
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+
+from metrics import stage_seconds, tracer
+
+# print every finished stage as a JSON span line
+TRACE_LOG = os.getenv("TRACE_LOG", "false").lower() == "true"
+
+# stage durations of the request being handled, None outside of a request
+current_stages = contextvars.ContextVar("current_stages", default=None)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def start_request():
+    stages = {}
+    current_stages.set(stages)
+    current_trace.set(uuid.uuid4().hex)
+    return stages
+
+
+@contextmanager
+def stage(name, **attributes):
+    stages = current_stages.get()
+    span = tracer.start_as_current_span(name, attributes=attributes) if tracer is not None else nullcontext()
+    start_time = time.perf_counter()
+    try:
+        with span:
+            yield
+    finally:
+        duration = time.perf_counter() - start_time
+        stage_seconds.labels(name).observe(duration)
+        if stages is not None:
+            stages[name] = stages.get(name, 0.0) + duration
+        if TRACE_LOG:
+            print(json.dumps({"trace_id": current_trace.get(), "span": name, "duration_ms": round(duration * 1000, 3), **attributes}))
+
+
+def in_context(func, *args):
+    # run_in_executor does not carry the context over, the pool thread records into the same request
+    return functools.partial(contextvars.copy_context().run, func, *args)
+
+
+def server_timing(stages):
+    # Server-Timing header value, durations in milliseconds
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in stages.items())
@@ -0,0 +1,24 @@
+import os
+
+# the worker only runs its event loop during a job, the scene index is refreshed instead of watched
+os.environ.setdefault("SCENE_WATCH", "false")
+# a worker runs one job at a time, there is never a second request to batch with
+os.environ.setdefault("BATCH_MAX_SIZE", "1")
+
+from dotenv import load_dotenv
+from redis import Redis
+from rq import Queue, SimpleWorker
+
+# load .env 
+load_dotenv()
+
+# loads the model once, every job of this worker reuses it
+import jobs
+
+# consumes the prompt jobs queued by the api, run as many workers on as many nodes as needed
+# usage: python worker.py
+redis_conn = Redis(host=os.getenv("REDIS_HOST", "redis"), port=6379)
+task_queue = Queue("task_queue", connection=redis_conn)
+
+print("Worker listening on task_queue...")
+SimpleWorker([task_queue], connection=redis_conn).work(with_scheduler=True)
@@ -25,6 +25,7 @@ function App() {
   const responseUrl = "http://localhost:8008/response";
   const llmStatusUrl = "http://localhost:8008/llm_status";
   const llmUrl = "http://localhost:8009/set/prompt";
+  const responseEventsUrl = "http://localhost:8008/events/response";
 
 
   useEffect(() => {
@@ -82,6 +83,27 @@ function App() {
     clearInterval(interval);
   }, []);
 
+  useEffect(() => {
+    // Unity responses are pushed by the API instead of polled
+    const events = new EventSource(responseEventsUrl);
+
+    events.onmessage = (event) => {
+      const currentResponse = JSON.parse(event.data);
+
+      if (currentResponse.available_prefabs && currentResponse.current_objects) {
+        setAvailablePrefabs(currentResponse.available_prefabs.split(', '));
+        setScenePrefabs(currentResponse.current_objects.split(', '));
+        setUnityStatus(true);
+      }
+    };
+
+    events.onerror = (error) => {
+      console.error("Error receiving Unity events:", error);
+    };
+
+    return () => events.close();
+  }, []);
+
   const handleUserInput = (e: React.ChangeEvent<HTMLInputElement>) => {
     setUserInstruction(e.target.value);
   }